@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timezone
+import pymongo
+import anilist
+import database
+import models
+import ratelimit
+
+# Who follows which airing show, one document per (user, anime).
+def collection():
+    return database.collection("airing_subscriptions")
+
+
+# Every followed show's schedule is re-read this often, in case AniList moved an episode.
+REFRESH_INTERVAL = 60 * 60
+# Shows that have just aired an episode are re-read on this shorter cycle to pick up the next one.
+STALE_INTERVAL = 5 * 60
+
+
+async def ensure_indexes():
+    await database.run(collection().create_index, [("user_id", pymongo.ASCENDING), ("anime_id", pymongo.ASCENDING)], unique=True, name="user_anime")
+    await database.run(collection().create_index, [("anime_id", pymongo.ASCENDING)], name="anime")
+
+
+async def follow(user_id: int, anime_id: int) -> bool:
+    """Subscribes a user to an anime's new episodes. Returns False if they already followed it. """
+    result = await database.run(collection().update_one, {"user_id": user_id, "anime_id": anime_id}, {"$setOnInsert": {"followed_at": datetime.now(timezone.utc)}}, upsert=True)
+    return result.upserted_id is not None
+
+
+async def unfollow(user_id: int, anime_id: int) -> bool:
+    result = await database.run(collection().delete_one, {"user_id": user_id, "anime_id": anime_id})
+    return result.deleted_count > 0
+
+
+async def subscribe(user_id: int, anime_id: int, next_episode: models.NextEpisode = None) -> bool:
+    """follow(), and start tracking the show's schedule if the scheduler is running, see AiringScheduler.track(). """
+    followed = await follow(user_id, anime_id)
+    if scheduler is not None:
+        scheduler.track(anime_id, next_episode)
+    return followed
+
+
+async def followers(anime_id: int) -> list:
+    subscriptions = collection()
+
+    def find():
+        return [subscription["user_id"] for subscription in subscriptions.find({"anime_id": anime_id}, {"_id": 0, "user_id": 1})]
+
+    return await database.run(find)
+
+
+async def followed_anime() -> list:
+    return await database.run(collection().distinct, "anime_id")
+
+
+class AiringScheduler:
+    """Sends a notification for every followed show at the moment each new episode airs.
+
+    Upcoming episodes sit in a min-heap ordered by air time, so scheduling and firing are O(log n), and a single task
+    sleeps until the earliest one is due instead of polling every show. A schedule that AniList moves is pushed again
+    and the outdated heap entry is skipped when it surfaces. Schedules are read in id_in batches through
+    anilist.get_airing_many(): every followed show on a slow cycle, and shows that have just aired on a faster one.
+
+    notify(anime_id, episode, airing_at) is awaited for each episode that airs. """
+
+    def __init__(self, notify):
+        self.notify = notify
+        self.tracked = set()
+        self._heap = []
+        self._scheduled = {}
+        self._stale = set()
+        # The last episode notified for each show, so a refresh that lands before AniList moves on can't repeat it.
+        self._fired = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        # Notifications being sent. Referenced here so they can't be garbage collected half way through.
+        self._notifying = set()
+
+    def schedule(self, anime_id: int, airing_at: int, episode: int):
+        if self._scheduled.get(anime_id) == (airing_at, episode) or episode <= self._fired.get(anime_id, 0):
+            return
+        self._scheduled[anime_id] = (airing_at, episode)
+        heapq.heappush(self._heap, (airing_at, anime_id, episode))
+        if self._heap[0][1] == anime_id:
+            # The new entry is now the earliest, so the sleeping timer has to be woken to shorten its wait.
+            self._wakeup.set()
+
+    def unschedule(self, anime_id: int):
+        # The heap entry is left in place and skipped when it comes up, see _fire_due().
+        self._scheduled.pop(anime_id, None)
+
+    def track(self, anime_id: int, next_episode: models.NextEpisode = None):
+        """Starts following a show's schedule (e.g. after its first subscriber), from the next episode the caller
+        already looked up if there is one. Nothing is fetched here, so a command can reply straight away; the next
+        short refresh cycle reads the schedule from AniList either way. """
+        if anime_id not in self.tracked:
+            self.tracked.add(anime_id)
+            # A cached episode time may already have passed, and firing it now would announce an old episode.
+            if next_episode is not None and next_episode.airing_at > time.time():
+                self.schedule(anime_id, next_episode.airing_at, next_episode.episode)
+            self._stale.add(anime_id)
+
+    def untrack(self, anime_id: int):
+        self.tracked.discard(anime_id)
+        self.unschedule(anime_id)
+
+    async def refresh(self, anime_ids: list) -> list:
+        """Re-reads the schedules of these shows. Returns the ids that couldn't be read, whose schedules are left as
+        they were. """
+        airing = await anilist.get_airing_many(anime_ids, ratelimit.BACKGROUND)
+        failed = []
+        for anime_id in anime_ids:
+            result = airing.get(anime_id)
+            if isinstance(result, list):
+                failed.append(anime_id)
+            elif result is None:
+                # Gone from AniList. Kept as it is rather than dropped on a hunch; notifying looks the show up again.
+                continue
+            elif result['next_airing_episode'] is not None and anime_id in self.tracked:
+                self.schedule(anime_id, result['next_airing_episode'].airing_at, result['next_airing_episode'].episode)
+            else:
+                # Finished, or the next episode isn't announced yet.
+                self.unschedule(anime_id)
+        return failed
+
+    async def start(self):
+        self.tracked = set(await followed_anime())
+        self._tasks = [asyncio.create_task(self._run_timer()), asyncio.create_task(self._run_refresh())]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def _fire_due(self):
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            airing_at, anime_id, episode = heapq.heappop(self._heap)
+            if self._scheduled.get(anime_id) != (airing_at, episode):
+                continue
+            del self._scheduled[anime_id]
+            self._fired[anime_id] = episode
+            self._stale.add(anime_id)
+            task = asyncio.create_task(self.notify(anime_id, episode, airing_at))
+            self._notifying.add(task)
+            task.add_done_callback(lambda t, anime_id=anime_id, episode=episode: self._notify_done(anime_id, episode, t))
+
+    def _notify_done(self, anime_id: int, episode: int, task: asyncio.Task):
+        self._notifying.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Notifying episode {episode} of anime {anime_id} failed: {task.exception()!r}")
+
+    async def _run_timer(self):
+        while True:
+            self._fire_due()
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_refresh(self):
+        last_full = None
+        while True:
+            if last_full is None or time.monotonic() - last_full >= REFRESH_INTERVAL:
+                last_full = time.monotonic()
+                stale, self._stale = list(self.tracked), set()
+            else:
+                stale, self._stale = list(self._stale & self.tracked), set()
+                # Shows followed through another shard's process, which has no scheduler of its own to track them.
+                try:
+                    new = set(await followed_anime()) - self.tracked
+                except Exception as e:
+                    print(f"Reading followed shows failed: {e!r}")
+                    new = set()
+                self.tracked |= new
+                stale += new
+            if stale:
+                try:
+                    failed = await self.refresh(stale)
+                except Exception as e:
+                    print(f"Airing schedule refresh failed: {e!r}")
+                    failed = stale
+                if failed:
+                    print(f"Airing schedules of {len(failed)} shows couldn't be read, retrying in {STALE_INTERVAL}s.")
+                self._stale.update(failed)
+            await asyncio.sleep(STALE_INTERVAL)
+
+
+# The running scheduler, created by the bot on start up. Only one process of a sharded deployment runs it, see
+# app.Context.primary, so each episode is announced once.
+scheduler = None
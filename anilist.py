@@ -1,35 +1,214 @@
-import requests
+import asyncio
+import dataclasses
 import json
-
-url = 'https://graphql.anilist.co'
-
-
-def get_multiple(name: str, anime_id: int = None, page: int = 1, status: str = None):
+import aiohttp
+import app
+import batch
+import cache
+import metrics
+import models
+import queries
+import ratelimit
+import resilience
+import search_index
+import singleflight
+import store
+
+# Titles, dates, descriptions and the like barely change, so they are kept for a day. The fields in VOLATILE_KEYS
+# move as episodes air and scores come in, so they are cached separately with a short TTL and refreshed on their own.
+STATIC_TTL = 24 * 60 * 60
+VOLATILE_TTL = 5 * 60
+VOLATILE_KEYS = ('airing_status', 'next_airing_episode', 'average_score')
+
+# Search result pages (titles and ids only) are kept for an hour.
+SEARCH_TTL = 60 * 60
+
+
+
+def _persistent() -> store.Store:
+    return app.get().store
+
+
+# Every cache below writes through to the application's store (opened on first use, see app.py) and reads it on a
+# miss, so a restart starts warm. The caches hold the records in models.py; namespaces are versioned so records
+# written in an older shape are never read back.
+media_cache = cache.TTLCache(ttl=STATIC_TTL, max_bytes=32 * 1024 * 1024, store=_persistent, namespace='media_v2',
+                             encode=models.Media.to_json, decode=models.Media.from_json)
+airing_cache = cache.TTLCache(ttl=VOLATILE_TTL, max_bytes=4 * 1024 * 1024, store=_persistent, namespace='airing_v2',
+                              encode=models.Media.volatile_to_json, decode=models.Media.volatile_from_json)
+character_cache = cache.TTLCache(ttl=STATIC_TTL, max_bytes=16 * 1024 * 1024, store=_persistent, namespace='character_v2',
+                                 encode=models.Character.to_json, decode=models.Character.from_json)
+search_cache = cache.TTLCache(ttl=SEARCH_TTL, max_bytes=8 * 1024 * 1024, store=_persistent, namespace='search_v2',
+                              encode=models.SearchPage.to_json, decode=models.SearchPage.from_json)
+
+limiter = ratelimit.RateLimiter()
+in_flight = singleflight.SingleFlight()
+breaker = resilience.CircuitBreaker('anilist')
+# How many times a failed request (throttled, a server error, a timeout or a dropped connection) is retried.
+MAX_RETRIES = 3
+# The longest one request may take. Callers with a deadline (see resilience.py) stop waiting sooner.
+ATTEMPT_TIMEOUT = 4.0
+# An interactive request still unanswered after its query's usual p95 is hedged with a second one. The delay stays
+# within these bounds, and is HEDGE_MAX until HEDGE_SAMPLES requests of that query have been timed.
+HEDGE_MIN = 0.25
+HEDGE_MAX = 2.0
+HEDGE_SAMPLES = 20
+
+# Largest page AniList serves, so the most ids one id_in query can resolve. Characters carry a nested media connection
+# that counts heavily towards AniList's query complexity limit, so they are fetched in smaller groups.
+BATCH_SIZE = 50
+CHARACTER_BATCH_SIZE = 10
+
+
+class _Retryable(Exception):
+    """A response worth sending the request again for: throttled, a server error or a garbled body. """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+_TOO_SLOW = 'AniList took too long to answer.'
+
+
+def _error(status: int, message: str) -> dict:
+    return {'data': None, 'errors': [{'message': message, 'status': status}]}
+
+
+def _unavailable(response: dict) -> bool:
+    """Whether an error response means AniList couldn't answer, rather than that the answer is an error. """
+    return any(error.get('status') == 429 or (error.get('status') or 0) >= 500 for error in response['errors'])
+
+
+async def _post(query: queries.Query, variables: dict, priority: int = ratelimit.INTERACTIVE) -> dict:
+    """Sends a query through the shared rate limiter and the resilience layer (see _send()). Never raises for
+    AniList's sake: timeouts, outages and throttling come back as normal error responses, with a status of 429 or 5xx.
+    Identical requests made while one is already in flight share its response (or its exception) instead of being
+    sent again, so the response must not be modified. Each caller still only waits until its own deadline. Requests
+    of different priorities aren't shared, so an interactive one never waits in the queue behind a background one. """
+    key = (query.sha256, json.dumps(variables, sort_keys=True, separators=(',', ':')), priority)
+    try:
+        return await resilience.within_deadline(in_flight.do(key, lambda: _send(query, variables, priority)))
+    except resilience.DeadlineExceeded:
+        metrics.anilist_failures.inc(query=query.name, reason='deadline')
+        return _error(504, _TOO_SLOW)
+
+
+async def _load(loader: batch.Batcher, key, priority: int):
+    """loader.load(key), given up on at the caller's deadline. The batch itself runs with no deadline, since it is
+    shared by callers with different ones. Returns a list of errors once the deadline has passed. """
+    try:
+        return await resilience.within_deadline(loader.load(key, priority))
+    except resilience.DeadlineExceeded:
+        metrics.anilist_failures.inc(query=loader.name, reason='deadline')
+        return _error(504, _TOO_SLOW)['errors']
+
+
+async def _send(query: queries.Query, variables: dict, priority: int) -> dict:
+    """Fails fast while the circuit breaker is open, and otherwise retries failed requests with jittered backoff and
+    hedges slow interactive ones. Runs shared by every caller of _post(), so under no caller's deadline. """
+    if not breaker.allow():
+        metrics.anilist_failures.inc(query=query.name, reason='circuit_open')
+        return _error(503, 'AniList is unavailable right now.')
+    try:
+        body = await resilience.retry(lambda: _hedged(query, variables, priority), MAX_RETRIES + 1, (_Retryable, aiohttp.ClientError, asyncio.TimeoutError))
+    except _Retryable as e:
+        if e.status == 429:
+            # Being throttled says nothing about AniList's health.
+            breaker.release()
+        else:
+            breaker.record_failure()
+        metrics.anilist_failures.inc(query=query.name, reason='throttled' if e.status == 429 else 'error')
+        return _error(e.status, e.message)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breaker.record_failure()
+        metrics.anilist_failures.inc(query=query.name, reason='timeout' if isinstance(e, asyncio.TimeoutError) else 'connection')
+        return _error(503, 'AniList is unavailable right now.')
+    except BaseException:
+        # Out of time or cancelled, which doesn't tell whether AniList is healthy either.
+        breaker.release()
+        raise
+    breaker.record_success()
+    return body
+
+
+def _hedge_delay(query: queries.Query) -> float:
+    labels = (('query', query.name),)
+    series = metrics.anilist_request_seconds.series.get(labels)
+    if series is None or sum(series[0]) < HEDGE_SAMPLES:
+        return HEDGE_MAX
+    return min(HEDGE_MAX, max(HEDGE_MIN, metrics.anilist_request_seconds.quantile(0.95, labels)))
+
+
+async def _hedged(query: queries.Query, variables: dict, priority: int) -> dict:
+    # Every query is a read, so sending one twice is harmless. Background work isn't worth the extra request.
+    if priority != ratelimit.INTERACTIVE:
+        return await _attempt(query, variables, priority)
+    return await resilience.hedge(lambda: _attempt(query, variables, priority), _hedge_delay(query))
+
+
+async def _attempt(query: queries.Query, variables: dict, priority: int) -> dict:
+    """Sends the request once. Raises _Retryable, aiohttp.ClientError or asyncio.TimeoutError if it should be sent
+    again, and resilience.DeadlineExceeded once the caller is out of time. """
+    context = app.get()
+    with metrics.ratelimit_wait_seconds.time():
+        await resilience.within_deadline(limiter.acquire(priority))
+    with metrics.anilist_request_seconds.time(query=query.name):
+        try:
+            timeout = aiohttp.ClientTimeout(total=resilience.timeout(ATTEMPT_TIMEOUT))
+            async with context.session.post(context.anilist_url, json={'query': query.text, 'variables': variables}, timeout=timeout) as response:
+                limiter.update(response.status, response.headers)
+                metrics.anilist_requests.inc(query=query.name, status=response.status)
+                if response.status == 429:
+                    raise _Retryable(429, 'Too Many Requests.')
+                if response.status >= 500:
+                    raise _Retryable(response.status, f'AniList answered with HTTP {response.status}.')
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = None
+                if not isinstance(body, dict):
+                    raise _Retryable(502, 'AniList sent back a malformed response.')
+        except asyncio.TimeoutError:
+            left = resilience.remaining()
+            if left is not None and left <= 0:
+                raise resilience.DeadlineExceeded() from None
+            raise
+    if body.get('data') is None:
+        body['data'] = None
+        body.setdefault('errors', [{'message': 'No data returned', 'status': response.status}])
+    return body
+
+
+def load_index(seed_path: str = None):
+    """Fills the local search index from every record in the persistent cache, plus an optional bulk seed file
+    (see search_index.seed()). Blocking; run it off the event loop. """
+    persistent = app.get().store
+    for media in persistent.values(media_cache.namespace):
+        search_index.add_anime(media['id'], media['name_romaji'], media['name_english'], media['synonyms'])
+    for character in persistent.values(character_cache.namespace):
+        search_index.add_character(character['id'], character['name'], character['alt_names'])
+    if seed_path is not None:
+        search_index.seed(seed_path)
+
+
+def _field(response: dict, name: str):
+    """Returns response['data'][name], or None when AniList sent back errors instead of data. """
+    if response['data'] is None:
+        return None
+    return response['data'][name]
+
+
+async def get_multiple(name: str, anime_id: int = None, page: int = 1, status: str = None, priority: int = ratelimit.INTERACTIVE, full: bool = True):
     """Responds with multiple anime which fit the search criteria (name and anime_id). Providing anime_id will always return 1 result.
-    If only 1 anime is retrieved, the function will automatically query get_anime() using the id, returning full data. """
-    query = """
-        query ($search: String, $id: Int, $page: Int, $perpage: Int, $status: MediaStatus) {
-            Page (page: $page, perPage: $perpage) {
-                pageInfo {
-                    total
-                    currentPage
-                    lastPage
-                    hasNextPage
-                }
-
-
-                media (search: $search, type: ANIME, id: $id, status: $status) {
-                    id
-                    title {
-                        romaji
-                        english
-                    }
-                }
-            }
-        }   
-    """
-
-    variables = {'perpage': 25}
+    Several results come back as a models.SearchPage. If only 1 anime is retrieved, its models.Media is returned instead (or its models.AiringInfo
+    when status is RELEASING).
+    With full set, the search fetches every field get_anime() needs in the same request, so that case costs one round trip and every
+    result is cached for the select menu. Pass full=False when only the titles are wanted, e.g. when paging. """
+    query = queries.SEARCH_MEDIA
+
+    variables = {'perPage': 25, 'full': full}
     if anime_id is not None:
         variables['id'] = anime_id
     if name is not None:
@@ -38,292 +217,284 @@ def get_multiple(name: str, anime_id: int = None, page: int = 1, status: str = N
         variables['status'] = status
     variables['page'] = page
 
-    response = json.loads(requests.post(url, json={'query': query, 'variables': variables}).text)
-    data = response['data']['Page']
-
-    if data is not None:
-        if len(data['media']) == 0:
-            return [{'message': 'Not Found', 'status': 404}]
-        elif len(data['media']) == 1 and data['pageInfo']['lastPage'] == 1:
-            if status == 'RELEASING':
-                return get_next_airing_episode(data['media'][0]['id'])
-            else:
-                return get_anime(data['media'][0]['id'])
+    # A name that matches exactly one title we've already seen is answered locally instead of by a search.
+    if name is not None and anime_id is None and status is None and page == 1:
+        ids = search_index.anime.exact(name)
+        if len(ids) == 1:
+            return await get_anime(next(iter(ids)), priority)
+
+    # RELEASING searches answer with airing times, which can't be served from an hour old page.
+    key = ('anime', name, anime_id, page, status)
+    cached = search_cache.get(key) if status != 'RELEASING' else None
+    if cached is not None and cached[1]:
+        data = cached[0]
+    else:
+        response = await _post(query, variables, priority)
+        data = _field(response, 'Page')
+        if data is None:
+            if cached is None or not _unavailable(response):
+                return response['errors']
+            # AniList is down or out of time; an expired page is better than an error.
+            data = cached[0]
+        else:
+            if full:
+                for media in data['media']:
+                    _store_media(media)
+                if status == 'RELEASING' and len(data['media']) == 1 and data['pageInfo']['lastPage'] == 1:
+                    return models.AiringInfo.from_graphql(data['media'][0])
+
+            data = models.SearchPage.from_media_page(data)
+            for result in data.results:
+                search_index.add_anime(result.id, result.label, result.description)
+            if status != 'RELEASING':
+                search_cache.set(key, data)
+
+    if len(data.results) == 0:
+        return [{'message': 'Not Found', 'status': 404}]
+    elif len(data.results) == 1 and data.last_page == 1:
+        result = data.results[0]
+        if status == 'RELEASING':
+            return await get_next_airing_episode(result.id, priority)
         else:
-            return data
+            # Usually cached already, by the full search above or an earlier lookup.
+            return await get_anime(result.id, priority)
     else:
-        return response['errors']
+        return data
 
 
-def get_anime(anime_id: int):
-    """Returns all required data formatted, about the anime using the ID. """
-    query = """
-        query ($id: Int) {
-            Media (type: ANIME, id: $id) {
-                id
-                title {
-                    romaji
-                    english
-                }
-                startDate {
-                    year
-                    month
-                    day
-                }
-                endDate {
-                    year
-                    month
-                    day
-                }
-                coverImage {
-                    large
-                    color
-                }
-                bannerImage
-                format
-                status
-                episodes
-                duration
-                season
-                description
-                averageScore
-                genres
-                nextAiringEpisode {
-                    airingAt
-                    timeUntilAiring
-                    episode
-                }
-                isAdult
-                countryOfOrigin
-                siteUrl
-                trailer {
-                    id
-                    site
-                }
-            }
-        }
-"""
-    variables = {'id': anime_id}
+async def get_anime(anime_id: int, priority: int = ratelimit.INTERACTIVE, volatile: bool = True):
+    """Returns the anime with this ID as a models.Media, or a list of errors.
+    Cached results are returned immediately, even once expired; expired parts are refreshed in the background. With
+    volatile=False, for callers that only want titles and the like, the VOLATILE_KEYS fields are left as they were
+    cached with the rest and never refreshed. """
+    cached = media_cache.get(anime_id)
+    if cached is None:
+        return await _fetch_anime(anime_id, priority)
 
-    response = json.loads(requests.post(url, json={'query': query, 'variables': variables}).text)
-    data = response['data']['Media']
+    data, fresh = cached
+    if not fresh:
+        media_cache.refresh(anime_id, lambda: _fetch_anime(anime_id, ratelimit.BACKGROUND))
 
-    if data is not None:
+    if not volatile:
+        return data
 
-        _id = data['id']
+    airing = airing_cache.get(anime_id)
+    if airing is not None:
+        data = dataclasses.replace(data, **airing[0])
+    if fresh and (airing is None or not airing[1]):
+        airing_cache.refresh(anime_id, lambda: _fetch_airing(anime_id))
 
-        name_romaji = data['title']['romaji']
-        name_english = data['title']['english']
+    return data
 
-        start_date = f"{data['startDate']['day']}/{data['startDate']['month']}/{data['startDate']['year']}"
-        end_date = f"{data['endDate']['day']}/{data['endDate']['month']}/{data['endDate']['year']}"
 
-        cover_image = data['coverImage']['large']
-        banner_image = data['bannerImage']
-        cover_color = data['coverImage']['color']
+def _store_media(data: dict) -> models.Media:
+    """Parses a full Media object and caches it. """
+    media = models.Media.from_graphql(data)
+    search_index.add_anime(media.id, media.name_romaji, media.name_english, media.synonyms)
+    media_cache.set(media.id, media)
+    airing_cache.set(media.id, {key: getattr(media, key) for key in VOLATILE_KEYS})
+    return media
 
-        airing_format = data['format']
-        airing_status = data['status'].replace('_', ' ').title()
-        airing_episodes = data['episodes']
-        if airing_status == 'Not Yet Released':
-            next_airing_episode = 'Not Yet Release'
-        else:
-            next_airing_episode = data['nextAiringEpisode']
-        season = data['season']
-        episode_duration = data['duration']
 
-        description = data['description']
-        average_score = data['averageScore']
-        genres = data['genres']
+async def get_anime_many(anime_ids: list, priority: int = ratelimit.INTERACTIVE, volatile: bool = True) -> dict:
+    """Returns {id: get_anime(id)} for every id. Whatever isn't cached is fetched in id_in batches of BATCH_SIZE. """
+    results = await asyncio.gather(*(get_anime(anime_id, priority, volatile) for anime_id in anime_ids))
+    return dict(zip(anime_ids, results))
 
-        is_adult = data['isAdult']
-        origin_country = data['countryOfOrigin'].lower()
 
-        site_url = data['siteUrl']
-        if data['trailer'] is None:
-            trailer_url = data['trailer']
-        else:
-            if data['trailer']['site'] == 'youtube':
-                trailer_url = f"https://youtube.com/watch?v={data['trailer']['id']}"
-            else:
-                trailer_url = f"https://dailymotion.com/video/{data['trailer']['id']}"
-        formatted_data = {'_id': _id, 'name_romaji': name_romaji, 'name_english': name_english, 'start_date': start_date, 'end_date': end_date, 'cover_image': cover_image,
-                          'banner_image': banner_image, 'cover_color': cover_color, 'airing_format': airing_format, 'airing_status': airing_status, 'airing_episodes': airing_episodes,
-                          'next_airing_episode': next_airing_episode, 'season': season, 'episode_duration': episode_duration, 'desc': description, 'average_score': average_score,
-                          'genres': genres, 'is_adult': is_adult, 'origin_country': origin_country, 'site_url': site_url, 'trailer_url': trailer_url}
+async def get_titles_many(anime_ids: list, priority: int = ratelimit.BACKGROUND) -> dict:
+    """Fetches only the titles and links of many anime, in id_in queries of BATCH_SIZE. Nothing is read from or
+    written to the caches, so bulk jobs don't push out the records interactive commands use. Returns
+    {id: models.MediaTitle, or a list of errors}. """
+    groups = [anime_ids[i:i + BATCH_SIZE] for i in range(0, len(anime_ids), BATCH_SIZE)]
+    results = {}
+    for group_results in await asyncio.gather(*(_fetch_titles(group, priority) for group in groups)):
+        results.update(group_results)
+    return results
 
-        return formatted_data
 
-    else:
-        return response['errors']
+async def _fetch_titles(anime_ids: list, priority: int) -> dict:
+    query = queries.TITLES_BY_IDS
+    variables = {'ids': anime_ids, 'perPage': len(anime_ids)}
 
+    response = await _post(query, variables, priority)
+    data = _field(response, 'Page')
 
-def get_next_airing_episode(anime_id: int):
-    query = """
-        query ($id: Int) {
-            Media (type: ANIME, id: $id) {
-                id
-                title {
-                    romaji
-                    english
-                }
-                episodes
-                nextAiringEpisode {
-                    airingAt
-                    timeUntilAiring
-                    episode
-                }
-            }
-        }
-    """
+    if data is None:
+        return {anime_id: response['errors'] for anime_id in anime_ids}
 
-    variables = {'id': anime_id}
+    results = {anime_id: [{'message': 'Not Found', 'status': 404}] for anime_id in anime_ids}
+    for media in data['media']:
+        results[media['id']] = models.MediaTitle.from_graphql(media)
+    return results
 
-    response = json.loads(requests.post(url, json={'query': query, 'variables': variables}).text)
-    data = response['data']['Media']
 
-    if data is not None:
-        print(data)
-        title = data['title']
-        next_airing_episode = data['nextAiringEpisode']
+async def _fetch_anime(anime_id: int, priority: int = ratelimit.INTERACTIVE):
+    return await _load(media_loader, anime_id, priority)
 
-        _id = data['id']
 
-        name_english = title['english']
-        name_romaji = title['romaji']
+async def _fetch_media_many(anime_ids: list, priority: int) -> dict:
+    """Fetches and caches up to BATCH_SIZE anime with one id_in query. Ids AniList doesn't return map to a Not Found error. """
+    query = queries.MEDIA_BY_IDS
+    variables = {'ids': anime_ids, 'perPage': len(anime_ids)}
 
-        total_episodes = data['episodes']
+    response = await _post(query, variables, priority)
+    data = _field(response, 'Page')
 
-        if next_airing_episode is None:
-            return {'name_english': name_english, 'name_romaji': name_romaji, 'id': _id, 'next_airing_episode': None, 'episodes': total_episodes}
+    if data is None:
+        return {anime_id: response['errors'] for anime_id in anime_ids}
 
-        airing_at = next_airing_episode['airingAt']
-        time_until_airing = next_airing_episode['timeUntilAiring']
-        episode = next_airing_episode['episode']
+    results = {anime_id: [{'message': 'Not Found', 'status': 404}] for anime_id in anime_ids}
+    for media in data['media']:
+        results[media['id']] = _store_media(media)
+    return results
 
-        formatted_data = {'name_english': name_english, 'name_romaji': name_romaji, 'airing_at': airing_at, 'time_until_airing': time_until_airing, 'episode': episode, 'id': _id,
-                          'next_airing_episode': True, 'episodes': total_episodes}
-        return formatted_data
-    else:
-        return response['errors']
+
+async def get_airing_many(anime_ids: list, priority: int = ratelimit.BACKGROUND) -> dict:
+    """Fetches the current airing_status, next_airing_episode and average_score of many anime, bypassing the cache.
+    Ids are combined into id_in queries of BATCH_SIZE. Returns {id: those fields, or a list of errors when the
+    request failed}; ids AniList doesn't return are left out. """
+    results = await asyncio.gather(*(_load(airing_loader, anime_id, priority) for anime_id in anime_ids))
+    return {anime_id: result for anime_id, result in zip(anime_ids, results) if result is not None}
+
+
+async def _fetch_airing(anime_id: int, priority: int = ratelimit.BACKGROUND):
+    """Refreshes only the short-lived fields of an already cached anime. """
+    await _load(airing_loader, anime_id, priority)
+
+
+async def _fetch_airing_many(anime_ids: list, priority: int) -> dict:
+    query = queries.AIRING_BY_IDS
+    variables = {'ids': anime_ids, 'perPage': len(anime_ids)}
+
+    response = await _post(query, variables, priority)
+    data = _field(response, 'Page')
+
+    if data is None:
+        return {anime_id: response['errors'] for anime_id in anime_ids}
+
+    results = {}
+    for media in data['media']:
+        results[media['id']] = models.Media.volatile_from_graphql(media)
+        airing_cache.set(media['id'], results[media['id']])
+    return results
 
 
-def get_character(char_id: int):
-    query = """
-    query ($id: Int) {
-        Character (id: $id) {
-            id
-            name {
-                full
-                alternative
-            }
-            image {
-                large
-            }
-            description (asHtml: false)
-            dateOfBirth {
-                year
-                month
-                day
-            }
-            gender
-            age
-            siteUrl
-            media (sort: POPULARITY_DESC) {
-                edges {
-                    node {
-                        title {
-                            romaji
-                            english
-                        }
-                        type
-                    }
-                }
-            }
-        }
-    }
-    """
-
-    variables = {'id': char_id}
-
-    response = json.loads(requests.post(url=url, json={'query': query, 'variables': variables}).text)
-    print(response)
-
-    data = response['data']
+async def get_anime_by_mal_ids(mal_ids: list, priority: int = ratelimit.BACKGROUND) -> dict:
+    """Looks anime up by MyAnimeList id, in id_in batches of BATCH_SIZE, caching them like any other fetch.
+    Returns {mal_id: models.Media, or a list of errors}. """
+    results = await asyncio.gather(*(_load(mal_loader, mal_id, priority) for mal_id in mal_ids))
+    return dict(zip(mal_ids, results))
+
+
+async def _fetch_mal_many(mal_ids: list, priority: int) -> dict:
+    query = queries.MEDIA_BY_MAL_IDS
+    variables = {'ids': mal_ids, 'perPage': len(mal_ids)}
+
+    response = await _post(query, variables, priority)
+    data = _field(response, 'Page')
+
+    if data is None:
+        return {mal_id: response['errors'] for mal_id in mal_ids}
+
+    results = {mal_id: [{'message': 'Not Found', 'status': 404}] for mal_id in mal_ids}
+    for media in data['media']:
+        results[media['idMal']] = _store_media(media)
+    return results
+
+
+# Named after the query each one sends, so its failures are counted under the same label as _post()'s.
+media_loader = batch.Batcher(_fetch_media_many, max_size=BATCH_SIZE, name=queries.MEDIA_BY_IDS.name)
+airing_loader = batch.Batcher(_fetch_airing_many, max_size=BATCH_SIZE, name=queries.AIRING_BY_IDS.name)
+mal_loader = batch.Batcher(_fetch_mal_many, max_size=BATCH_SIZE, name=queries.MEDIA_BY_MAL_IDS.name)
+
+
+async def get_next_airing_episode(anime_id: int, priority: int = ratelimit.INTERACTIVE):
+    query = queries.NEXT_AIRING
+
+    variables = {'id': anime_id}
+
+    response = await _post(query, variables, priority)
+    data = _field(response, 'Media')
 
     if data is not None:
-        data = data['Character']
-
-        _id = data['id']
-        name = data['name']['full']
-        alt_names = data['name']['alternative']
-        description = data['description']
-        gender = data['gender']
-        age = data['age']
-        site_url = data['siteUrl']
-        birthdate = f"{data['dateOfBirth']['day']}/{data['dateOfBirth']['month']}/{data['dateOfBirth']['year']}"
-        image = data['image']['large']
-        appears_in = []
-        for media in data['media']['edges']:
-            node = media['node']
-            appears_in.append({'type': node['type'].lower(), 'name_english': node['title']['english'], 'name_romaji': node['title']['romaji']})
-
-        formatted_data = {'id': _id, 'name': name, 'alt_names': alt_names, 'description': description, 'gender': gender, 'age': age, 'site_url': site_url, 'birthdate': birthdate,
-                          'appears_in': appears_in, 'image': image, 'multiple': False}
-
-        return formatted_data
+        return models.AiringInfo.from_graphql(data)
     else:
         return response['errors']
 
 
-def get_characters(name: str, char_id: int = None, page: int = 1):
-    query = """
-    query ($name: String, $id: Int, $page: Int, $per_page: Int) {
-        Page (page: $page, perPage: $per_page) {
-            pageInfo {
-                total
-                currentPage
-                lastPage
-                hasNextPage
-            }
-
-            characters (search: $name, id: $id) {
-                id
-                name {
-                    full
-                }
-                gender
-                media {
-                    edges {
-                        node {
-                            title {
-                                english
-                                romaji
-                            }
-                        }
-                    }
-                }
-
-            }
-        }
-    }
-    """
-
-    variables = {'per_page': 25}
+async def get_character(char_id: int, priority: int = ratelimit.INTERACTIVE):
+    cached = character_cache.get(char_id)
+    if cached is None:
+        return await _fetch_character(char_id, priority)
+
+    data, fresh = cached
+    if not fresh:
+        character_cache.refresh(char_id, lambda: _fetch_character(char_id, ratelimit.BACKGROUND))
+    return data
+
+
+async def _fetch_character(char_id: int, priority: int = ratelimit.INTERACTIVE):
+    return await _load(character_loader, char_id, priority)
+
+
+async def _fetch_character_many(char_ids: list, priority: int) -> dict:
+    query = queries.CHARACTERS_BY_IDS
+    variables = {'ids': char_ids, 'perPage': len(char_ids)}
+
+    response = await _post(query, variables, priority)
+    data = _field(response, 'Page')
+
+    if data is None:
+        return {char_id: response['errors'] for char_id in char_ids}
+
+    results = {char_id: [{'message': 'Not Found', 'status': 404}] for char_id in char_ids}
+    for character in data['characters']:
+        character = models.Character.from_graphql(character)
+        search_index.add_character(character.id, character.name, character.alt_names)
+        character_cache.set(character.id, character)
+        results[character.id] = character
+    return results
+
+
+character_loader = batch.Batcher(_fetch_character_many, max_size=CHARACTER_BATCH_SIZE, name=queries.CHARACTERS_BY_IDS.name)
+
+
+async def get_characters(name: str, char_id: int = None, page: int = 1, priority: int = ratelimit.INTERACTIVE):
+    query = queries.SEARCH_CHARACTERS
+
+    variables = {'perPage': 25}
     if name is not None:
         variables['name'] = name
     if char_id is not None:
         variables['id'] = char_id
     variables['page'] = page
 
-    response = json.loads(requests.post(url=url, json={'query': query, 'variables': variables}).text)
-    data = response['data']['Page']
+    if name is not None and char_id is None and page == 1:
+        ids = search_index.characters.exact(name)
+        if len(ids) == 1:
+            return await get_character(next(iter(ids)), priority)
 
-    if data is not None:
-        if len(data['characters']) == 0:
-            return [{'message': 'Not Found', 'status': 404}]
-        elif len(data['characters']) == 1:
-            return get_character(data['characters'][0]['id'])
+    key = ('character', name, char_id, page)
+    cached = search_cache.get(key)
+    if cached is not None and cached[1]:
+        data = cached[0]
+    else:
+        response = await _post(query, variables, priority)
+        data = _field(response, 'Page')
+        if data is None:
+            if cached is None or not _unavailable(response):
+                return response['errors']
+            data = cached[0]
         else:
-            data['multiple'] = True
-            return data
+            data = models.SearchPage.from_character_page(data)
+            search_cache.set(key, data)
+            for result in data.results:
+                search_index.add_character(result.id, result.label)
+
+    if len(data.results) == 0:
+        return [{'message': 'Not Found', 'status': 404}]
+    elif len(data.results) == 1:
+        return await get_character(data.results[0].id, priority)
+    else:
+        return data
@@ -0,0 +1,76 @@
+import asyncio
+
+import ratelimit
+import resilience
+
+
+class Batcher:
+    """Combines lookups made within a short window into a single request.
+
+    load(key) queues the key and waits. Once `window` seconds have passed since the first queued key, or `max_size`
+    keys are queued, every queued key is handed to fetch_many(keys, priority) in one call. fetch_many returns a dict
+    of key -> result, and each waiter gets its own entry back (None if the key was missing from the response).
+    If fetch_many raises, every waiter in that batch gets the exception. A key that is already part of a batch in
+    flight waits for that batch instead of being queued again. `name` labels the batcher, e.g. in metrics. """
+
+    def __init__(self, fetch_many, window: float = 0.005, max_size: int = 50, name: str = None):
+        self.fetch_many = fetch_many
+        self.name = name
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._in_flight = {}
+        self._priority = ratelimit.BACKGROUND
+        self._timer = None
+
+    async def load(self, key, priority: int = ratelimit.INTERACTIVE):
+        future = self._in_flight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+        # The batch is sent with the most urgent priority of anything waiting on it.
+        self._priority = min(self._priority, priority)
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+        # shield() so one cancelled waiter doesn't cancel the result for everyone else sharing the key.
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, priority = self._pending, self._priority
+        self._pending, self._priority = {}, ratelimit.BACKGROUND
+        if batch:
+            self._in_flight.update(batch)
+            # Without a deadline: it is shared by every waiter in the batch, each of which has its own.
+            resilience.detach(self._run(batch, priority))
+
+    async def _run(self, batch: dict, priority: int):
+        try:
+            await self._fetch(batch, priority)
+        finally:
+            for key, future in batch.items():
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+
+    async def _fetch(self, batch: dict, priority: int):
+        try:
+            results = await self.fetch_many(list(batch), priority)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
@@ -0,0 +1,372 @@
+"""Offline benchmarks for the AniList client, the Discord UI code and the rewatch list.
+
+Nothing leaves the machine: AniList is replaced by FakeAniList, a local GraphQL stand-in with configurable latency,
+jitter and injected 429s, and MongoDB by an in-memory mongomock database unless --mongo names a real one. Each
+scenario drives the same code a real interaction runs, through mock interaction objects, and reports throughput and
+latency percentiles of what a user would wait on.
+
+    python benchmark.py                                   # every scenario with the defaults
+    python benchmark.py --scenario search --latency 0.08 --jitter 0.03 --throttle 0.02
+    python benchmark.py --scenario rw --mongo mongodb://localhost:27017
+    python benchmark.py --replay responses.jsonl          # serve recorded AniList responses where they match
+
+A replay file holds one {"query": <query name>, "variables": {...}, "response": {...}} object per line, e.g. real
+responses saved from graphql.anilist.co. Requests without a recorded response get synthetic data. """
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from aiohttp import web
+import anilist
+import app
+import database
+# main.py's commands, under another name since this module has a main() of its own.
+import main as commands
+import metrics
+import models
+import queries
+import resilience
+import rewatch
+import utility
+
+# Results every synthetic search has, so pages are comparable between runs.
+SEARCH_TOTAL = 100
+# Offset for the Discord user ids the benchmark writes, well clear of real snowflakes.
+USER_ID_BASE = 10 ** 17
+
+DESCRIPTION = ("A <i>fake</i> anime served by benchmark.py.<br>\n" + "Long enough to be cut at the embed field limit. " * 30)
+
+
+def _media(media_id: int, full: bool = True) -> dict:
+    media = {'id': media_id, 'title': {'romaji': f"Fake Anime {media_id}", 'english': f"Fake Anime {media_id} EN" if media_id % 3 else None}}
+    if not full:
+        return media
+    releasing = media_id % 4 == 0
+    media.update({
+        'startDate': {'year': 2000 + media_id % 25, 'month': 1 + media_id % 12, 'day': 1 + media_id % 28},
+        'endDate': {'year': None, 'month': None, 'day': None} if releasing else {'year': 2001 + media_id % 25, 'month': 3, 'day': 20},
+        'nextAiringEpisode': {'airingAt': int(time.time()) + 3600 + media_id % 86400, 'timeUntilAiring': 3600, 'episode': 1 + media_id % 12} if releasing else None,
+        'synonyms': [f"FA{media_id}"],
+        'coverImage': {'large': f"https://example.com/cover/{media_id}.png", 'color': '#%06x' % (media_id * 2654435761 % 0xFFFFFF)},
+        'bannerImage': f"https://example.com/banner/{media_id}.png",
+        'format': 'TV',
+        'status': 'RELEASING' if releasing else 'FINISHED',
+        'episodes': None if releasing else 12,
+        'duration': 24,
+        'season': ('WINTER', 'SPRING', 'SUMMER', 'FALL')[media_id % 4],
+        'description': DESCRIPTION,
+        'averageScore': 50 + media_id % 50,
+        'genres': ['Action', 'Drama'],
+        'isAdult': False,
+        'countryOfOrigin': 'JP',
+        'siteUrl': f"https://anilist.co/anime/{media_id}",
+        'trailer': {'id': f"trailer{media_id}", 'site': 'youtube'} if media_id % 2 else None,
+    })
+    return media
+
+
+def _character(char_id: int, full: bool = True) -> dict:
+    edges = [{'node': {'title': {'romaji': f"Fake Anime {char_id % 1000}", 'english': None}, 'type': 'ANIME'}}]
+    character = {'id': char_id, 'name': {'full': f"Fake Character {char_id}"}, 'gender': ('Male', 'Female', None)[char_id % 3], 'media': {'edges': edges}}
+    if full:
+        character['name']['alternative'] = [f"FC{char_id}"]
+        character.update({
+            'image': {'large': f"https://example.com/character/{char_id}.png"},
+            'description': "__Fake__ character. ~!A spoiler!~ " * 40,
+            'dateOfBirth': {'year': None, 'month': 1 + char_id % 12, 'day': 1 + char_id % 28},
+            'age': str(10 + char_id % 30),
+            'siteUrl': f"https://anilist.co/character/{char_id}",
+        })
+    return character
+
+
+def _search_page(name: str, page: int, per_page: int, make) -> dict:
+    base = zlib.crc32((name or '').encode()) % 10 ** 6 * 1000
+    last_page = -(-SEARCH_TOTAL // per_page)
+    first = (page - 1) * per_page
+    items = [make(base + i) for i in range(first, min(first + per_page, SEARCH_TOTAL))]
+    return items, {'total': SEARCH_TOTAL, 'currentPage': page, 'lastPage': last_page, 'hasNextPage': page < last_page}
+
+
+def synthesize(name: str, variables: dict) -> dict:
+    """Builds a plausible response to one of the documents in queries.py. """
+    if name == 'SearchMedia':
+        full = variables.get('full', True)
+        if variables.get('id') is not None:
+            media, page_info = [_media(variables['id'], full)], {'total': 1, 'currentPage': 1, 'lastPage': 1, 'hasNextPage': False}
+        else:
+            media, page_info = _search_page(variables.get('search'), variables.get('page', 1), variables.get('perPage', 25), lambda media_id: _media(media_id, full))
+        return {'data': {'Page': {'pageInfo': page_info, 'media': media}}}
+    if name == 'MediaByIds':
+        return {'data': {'Page': {'media': [_media(media_id) for media_id in variables['ids']]}}}
+    if name == 'TitlesByIds':
+        return {'data': {'Page': {'media': [{key: _media(media_id)[key] for key in ('id', 'title', 'siteUrl')} for media_id in variables['ids']]}}}
+    if name == 'AiringByIds':
+        fields = ('id', 'status', 'averageScore', 'nextAiringEpisode')
+        return {'data': {'Page': {'media': [{key: _media(media_id)[key] for key in fields} for media_id in variables['ids']]}}}
+    if name == 'NextAiring':
+        media = _media(variables['id'])
+        return {'data': {'Media': {key: media[key] for key in ('id', 'title', 'nextAiringEpisode', 'episodes')}}}
+    if name == 'CharactersByIds':
+        return {'data': {'Page': {'characters': [_character(char_id) for char_id in variables['ids']]}}}
+    if name == 'SearchCharacters':
+        if variables.get('id') is not None:
+            characters, page_info = [_character(variables['id'], False)], {'total': 1, 'currentPage': 1, 'lastPage': 1, 'hasNextPage': False}
+        else:
+            characters, page_info = _search_page(variables.get('name'), variables.get('page', 1), variables.get('perPage', 25), lambda char_id: _character(char_id, False))
+        return {'data': {'Page': {'pageInfo': page_info, 'characters': characters}}}
+    return {'data': None, 'errors': [{'message': f"Unknown query {name}", 'status': 400}]}
+
+
+def _replay_key(name: str, variables: dict) -> tuple:
+    return name, json.dumps(variables, sort_keys=True)
+
+
+class FakeAniList:
+    """A local stand-in for graphql.anilist.co.
+
+    Each request is held for `latency` seconds, give or take up to `jitter`, then answered with a recorded response
+    if one matches the query and variables exactly, or with synthetic data otherwise. A `throttle` fraction of
+    requests is answered with a 429 and Retry-After instead. Every response carries AniList's X-RateLimit-* headers
+    with `rate_limit` as the per-minute limit. """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, throttle: float = 0.0, retry_after: float = 1.0, rate_limit: int = 6000,
+                 replay: str = None, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.names = {value.text: value.name for value in vars(queries).values() if isinstance(value, queries.Query)}
+        self.recorded = {}
+        self.requests = {}
+        self.throttled = 0
+        self._runner = None
+        if replay is not None:
+            with open(replay, encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.recorded[_replay_key(entry['query'], entry['variables'])] = entry['response']
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        name = self.names.get(body['query'], 'Unknown')
+        variables = body.get('variables') or {}
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.random.random() < self.throttle:
+            self.throttled += 1
+            return web.json_response({'data': None, 'errors': [{'message': 'Too Many Requests.', 'status': 429}]}, status=429,
+                                     headers={'Retry-After': str(self.retry_after), 'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': '0'})
+
+        response = self.recorded.get(_replay_key(name, variables))
+        if response is None:
+            response = synthesize(name, variables)
+        return web.json_response(response, headers={'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(self.rate_limit)})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Starts serving and returns the endpoint's url. Port 0 picks a free one. """
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}/"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeResponse:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, content: str = None, **kwargs):
+        self.done = True
+        self.interaction.sent.append((content, kwargs))
+
+
+class FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+
+    async def send(self, content: str = None, **kwargs):
+        self.interaction.sent.append((content, kwargs))
+
+    async def edit_message(self, message_id: int, **kwargs):
+        self.interaction.sent.append((None, kwargs))
+
+
+class FakeInteraction:
+    """Just enough of discord.Interaction for the commands and views to run: everything they send is kept in `sent`. """
+
+    def __init__(self, user_id: int):
+        self.user = SimpleNamespace(id=user_id, name=f"user{user_id}", avatar=None)
+        self.created_at = datetime.now(timezone.utc)
+        self.message = SimpleNamespace(id=user_id)
+        self.extras = {}
+        self.sent = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+class Recorder:
+    """Collects the latency of every user-facing step a scenario measures. """
+
+    def __init__(self):
+        self.samples = []
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append(time.perf_counter() - start)
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def search_select(args, recorder: Recorder, i: int):
+    """A search that lands on a select menu, then a pick from it (Options.callback). """
+    name = f"title {i % args.names}"
+    interaction = FakeInteraction(USER_ID_BASE + i)
+    with recorder.measure():
+        page = await anilist.get_multiple(name=name)
+    view = utility.View(data=page, name=name, remove=False)
+    view.select_class._values = [str(page.results[i % len(page.results)].id)]
+    with recorder.measure():
+        await view.select_class.callback(interaction)
+
+
+async def pagination(args, recorder: Recorder, i: int):
+    """A search's select menu paged all the way forward and back again. """
+    name = f"title {i % args.names}"
+    page = await anilist.get_multiple(name=name)
+    view = utility.View(data=page, name=name, remove=False)
+    for button in [view.right] * (view.last_page - 1) + [view.left] * (view.last_page - 1):
+        with recorder.measure():
+            await button.callback(FakeInteraction(USER_ID_BASE + i))
+
+
+async def rewatch_list(args, recorder: Recorder, i: int):
+    """/rw on a long list, then the first few pages after it. """
+    user_id = USER_ID_BASE + i % args.users
+    interaction = FakeInteraction(user_id)
+    with recorder.measure():
+        await commands.rw.callback(interaction)
+    view = interaction.sent[-1][1]["view"]
+    for _ in range(min(args.pages, view.last_page - 1)):
+        with recorder.measure():
+            await view.right.callback(FakeInteraction(user_id))
+
+
+async def setup_rewatch(args):
+    await rewatch.ensure_indexes()
+    animes = [models.Media.from_graphql(_media(anime_id)) for anime_id in range(1, args.entries + 1)]
+    for user in range(args.users):
+        await rewatch.bulk_upsert(USER_ID_BASE + user, animes)
+
+
+async def teardown_rewatch(args):
+    await database.run(rewatch.collection().delete_many, {"user_id": {"$gte": USER_ID_BASE, "$lt": USER_ID_BASE + args.users}})
+
+
+SCENARIOS = {
+    'search': (search_select, None, None),
+    'pagination': (pagination, None, None),
+    'rw': (rewatch_list, setup_rewatch, teardown_rewatch),
+}
+
+
+async def run_scenario(args, name: str) -> dict:
+    scenario, setup, teardown = SCENARIOS[name]
+    if setup is not None:
+        await setup(args)
+    recorder = Recorder()
+    operations = iter(range(args.iterations))
+
+    async def worker():
+        for i in operations:
+            await scenario(args, recorder, i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    if teardown is not None:
+        await teardown(args)
+
+    return {'scenario': name, 'samples': len(recorder.samples), 'seconds': elapsed, 'per_second': len(recorder.samples) / elapsed,
+            **{f"p{round(q * 100)}_ms": recorder.percentile(q) * 1000 for q in (0.5, 0.95, 0.99)}, 'max_ms': max(recorder.samples, default=0) * 1000}
+
+
+async def main(args):
+    fake = FakeAniList(args.latency, args.jitter, args.throttle, args.retry_after, args.rate_limit, args.replay, args.seed)
+    cache_dir = tempfile.mkdtemp(prefix="anilist-bench-")
+    await app.start(anilist_url=await fake.start(), cache_path=os.path.join(cache_dir, "cache.sqlite3"), mongodb_uri=args.mongo)
+
+    try:
+        results = [await run_scenario(args, name) for name in (SCENARIOS if args.scenario == 'all' else [args.scenario])]
+    finally:
+        # View prefetches and cache refreshes may still be running, and would reopen a session after the stop.
+        await resilience.cancel_detached()
+        await app.stop()
+        await fake.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({'results': results, 'anilist_requests': fake.requests, 'throttled': fake.throttled}, indent=2))
+        return
+
+    print(f"{'scenario':<12}{'samples':>9}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for result in results:
+        print(f"{result['scenario']:<12}{result['samples']:>9}{result['per_second']:>10.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['max_ms']:>10.2f}")
+    print(f"\nAniList requests: {sum(fake.requests.values())} {fake.requests}, {fake.throttled} throttled")
+    lookups = {}
+    for labels, value in metrics.cache_lookups.values.items():
+        labels = dict(labels)
+        lookups.setdefault(labels['cache'], {})[labels['result']] = int(value)
+    print(f"Cache lookups: {lookups}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a local AniList stand-in.")
+    parser.add_argument("--scenario", choices=['all', *SCENARIOS], default='all')
+    parser.add_argument("--iterations", type=int, default=200, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="simulated users working at once")
+    parser.add_argument("--names", type=int, default=50, help="distinct search terms, fewer means more cache hits")
+    parser.add_argument("--users", type=int, default=10, help="rewatch lists for the rw scenario")
+    parser.add_argument("--entries", type=int, default=1000, help="entries on each rewatch list")
+    parser.add_argument("--pages", type=int, default=5, help="pages turned after each /rw")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake AniList takes to answer")
+    parser.add_argument("--jitter", type=float, default=0.02, help="up to this many seconds either way on top of --latency")
+    parser.add_argument("--throttle", type=float, default=0.0, help="fraction of requests answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with every 429")
+    parser.add_argument("--rate-limit", type=int, default=6000, help="X-RateLimit-Limit the fake AniList advertises, per minute")
+    parser.add_argument("--replay", help="JSON Lines file of recorded responses to serve")
+    parser.add_argument("--mongo", default="mongomock://", help="MongoDB to use, mongomock:// for an in-memory one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    asyncio.run(main(parser.parse_args()))
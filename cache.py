@@ -0,0 +1,134 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+import metrics
+import resilience
+
+
+def _sizeof(value) -> int:
+    """Rough deep size of a cached AniList record in bytes. Only walks containers and slotted models (see models.py). """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(key) + _sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_sizeof(item) for item in value)
+    elif hasattr(value, '__slots__'):
+        size += sum(_sizeof(getattr(value, name)) for name in value.__slots__)
+    return size
+
+
+class TTLCache:
+    """LRU cache with a per-entry time to live, bounded by an approximate memory budget (max_bytes).
+
+    Expired entries are not dropped. get() hands them back marked as stale so the caller can serve them straight away
+    and start a background refresh(); they only leave the cache when the memory budget evicts them.
+
+    Given a store.Store (or a function returning one, called on first use), the cache writes through to it under `namespace` and falls back to it on a miss, so entries
+    survive restarts. How fresh a record read back from the store is depends on when it was originally stored. Values
+    that aren't plain JSON are converted with `encode` on the way to the store and `decode` on the way back.
+    The store is also checked before an expired entry is reported stale, since another process sharing it (another
+    shard) may have fetched the record since.
+
+    Every callable in `listeners` is called with the key whenever set() replaces an entry, so anything derived from
+    the cached values can be dropped with them. """
+
+    def __init__(self, ttl: float, max_bytes: int, store=None, namespace: str = None, encode=None, decode=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._store = store
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self.size = 0
+        self.listeners = []
+        self._entries = OrderedDict()
+        self._refreshing = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def store(self):
+        if callable(self._store):
+            self._store = self._store()
+        return self._store
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key):
+        """Returns (value, fresh) for a cached key, or None on a miss. """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            entry = self._load(key, entry)
+            if entry is None:
+                metrics.cache_lookups.inc(cache=self.namespace, result='miss')
+                return None
+        self._entries.move_to_end(key)
+        value, expires_at, _, _ = entry
+        fresh = time.monotonic() < expires_at
+        metrics.cache_lookups.inc(cache=self.namespace, result='hit' if fresh else 'stale')
+        return value, fresh
+
+    def _load(self, key, current=None):
+        """Reads a key back from the store, unless the stored record is no newer than `current`. """
+        if self.store is None:
+            return current
+        stored = self.store.get(self.namespace, key)
+        if stored is None or (current is not None and stored[1] <= current[3]):
+            return current
+        value, stored_at = stored
+        if self.decode is not None:
+            value = self.decode(value)
+        self._insert(key, value, self.ttl - (time.time() - stored_at), stored_at)
+        return self._entries.get(key)
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+        stored_at = time.time()
+        self._insert(key, value, ttl, stored_at)
+        if self.store is not None:
+            self.store.put(self.namespace, key, self.encode(value) if self.encode is not None else value, stored_at)
+        for listener in self.listeners:
+            listener(key)
+
+    def _insert(self, key, value, ttl: float, stored_at: float):
+        self.pop(key)
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        # stored_at is wall-clock time, comparable with the store's records and across processes.
+        self._entries[key] = (value, time.monotonic() + ttl, size, stored_at)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[2]
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def refresh(self, key, fetch):
+        """Runs fetch() as a background task, unless a refresh for the same key is already in flight.
+        fetch is expected to store its own result with set(). """
+        if key in self._refreshing:
+            return
+        # Detached from the caller's deadline: nobody waits on a refresh.
+        task = resilience.detach(fetch())
+        self._refreshing[key] = task
+        task.add_done_callback(lambda t: self._refresh_done(key, t))
+
+    def _refresh_done(self, key, task: asyncio.Task):
+        self._refreshing.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            # A failed refresh leaves the stale entry in place; the next lookup will try again.
+            print(f"Cache refresh for {key} failed: {task.exception()!r}")
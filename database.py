@@ -0,0 +1,40 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import pymongo
+import app
+import metrics
+
+# pymongo is blocking, so every database call runs on this executor instead of the event loop. It has as many threads
+# as the client has pooled connections, so a thread never waits on the pool and a slow Atlas round trip only holds up
+# the interaction that made it.
+POOL_SIZE = 20
+
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="mongo")
+
+
+def connect(uri: str):
+    """Creates the MongoDB client for app.Context. "mongomock://" gives an in-memory mongomock client instead. """
+    if uri.startswith("mongomock://"):
+        import mongomock
+        return mongomock.MongoClient()
+    return pymongo.MongoClient(
+        uri,
+        maxPoolSize=POOL_SIZE,
+        minPoolSize=2,
+        maxIdleTimeMS=5 * 60 * 1000,
+        connectTimeoutMS=5000,
+        serverSelectionTimeoutMS=5000,
+    )
+
+
+def collection(name: str):
+    """Returns a collection of the bot's database, connecting on first use. """
+    return app.get().db[name]
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking pymongo call on the database executor and waits for it without blocking the loop.
+    Its time, including any wait for a free thread, is recorded under the function's name. """
+    with metrics.mongo_seconds.time(op=getattr(func, '__name__', 'call')):
+        return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
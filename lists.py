@@ -0,0 +1,231 @@
+"""Moving rewatch lists in and out as files.
+
+export() writes a list as JSON Lines, one entry per line, reading it a page at a time. import_list() reads either
+
+    JSON Lines with an AniList id ("anime_id", as export() writes, or "mediaId") or a MyAnimeList id ("mal_id" or
+    "idMal") on each line, or
+    a MyAnimeList XML list export, gzipped or not. AniList's own list export is in the same format.
+
+Files are downloaded and parsed a chunk at a time, and looked up on AniList BATCH_SIZE entries at a time, so only
+the short title snapshots of the matched entries are held until the single bulk write at the end. If AniList fails
+part way, whatever was matched until then is still written, and the import is reported as partial. """
+import asyncio
+import json
+import tempfile
+import zlib
+from contextlib import aclosing
+from typing import NamedTuple, Optional
+from xml.etree import ElementTree
+import aiohttp
+import anilist
+import app
+import models
+import ratelimit
+import rewatch
+
+# Entries read from one file; anything after that is left out of the import.
+MAX_ENTRIES = 5000
+# Bytes of (decompressed) file read at most, and of a single JSON line.
+MAX_BYTES = 32 * 1024 * 1024
+MAX_LINE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# Entries per database read while exporting.
+EXPORT_PAGE_SIZE = 500
+# Exports this small stay in memory; bigger ones are spooled to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+# Seconds to connect, and then to wait for each read. Not a total: the download pauses while entries are looked up.
+DOWNLOAD_TIMEOUT = 60
+
+
+class ImportResult(NamedTuple):
+    added: int
+    matched: int
+    unmatched: int
+    truncated: bool
+    # AniList's error message if it failed part way, in which case entries after the failed batch weren't read.
+    error: Optional[str] = None
+
+
+async def export(user_id: int):
+    """Returns (file, entry count), with the file positioned at its start. """
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    count = 0
+    after = None
+    while True:
+        entries, has_next = await rewatch.list_page(user_id, after, EXPORT_PAGE_SIZE)
+        for entry in entries:
+            line = {"anime_id": entry["anime_id"], "name_romaji": entry.get("name_romaji"), "name_english": entry.get("name_english"), "link": entry.get("link")}
+            file.write(json.dumps(line, ensure_ascii=False).encode() + b'\n')
+        count += len(entries)
+        if not has_next:
+            break
+        after = entries[-1]["_id"]
+    file.seek(0)
+    return file, count
+
+
+def _reference(entry: dict):
+    """Returns ('anilist' or 'mal', id) for one JSON Lines entry, or None if it names no anime. """
+    for kind, field in (('anilist', 'anime_id'), ('anilist', 'mediaId'), ('mal', 'mal_id'), ('mal', 'idMal')):
+        if isinstance(entry.get(field), int) and entry[field] > 0:
+            return kind, entry[field]
+    return None
+
+
+class _JSONLines:
+    def __init__(self):
+        self._buffer = b''
+
+    def _parse(self, lines: list) -> list:
+        references = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                raise ValueError("The file isn't valid JSON Lines.") from None
+            reference = _reference(entry) if isinstance(entry, dict) else None
+            if reference is not None:
+                references.append(reference)
+        return references
+
+    def feed(self, data: bytes) -> list:
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        if len(self._buffer) > MAX_LINE:
+            raise ValueError("A line of the file is too long.")
+        return self._parse(lines)
+
+    def close(self) -> list:
+        return self._parse([self._buffer])
+
+
+class _MALXML:
+    def __init__(self):
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._root = None
+
+    def _read(self) -> list:
+        references = []
+        try:
+            for event, element in self._parser.read_events():
+                if event == 'start':
+                    if self._root is None:
+                        self._root = element
+                elif element.tag == 'anime':
+                    mal_id = (element.findtext('series_animedb_id') or '').strip()
+                    if mal_id.isdigit() and int(mal_id) > 0:
+                        references.append(('mal', int(mal_id)))
+                    # Drop every finished entry so the tree never grows past the one being read.
+                    self._root.clear()
+        except ElementTree.ParseError:
+            raise ValueError("The file isn't a valid MyAnimeList export.") from None
+        return references
+
+    def feed(self, data: bytes) -> list:
+        self._parser.feed(data)
+        return self._read()
+
+    def close(self) -> list:
+        try:
+            self._parser.close()
+        except ElementTree.ParseError:
+            raise ValueError("The file isn't a valid MyAnimeList export.") from None
+        return self._read()
+
+
+def _inflate(decompressor, chunk: bytes):
+    # Inflated CHUNK_SIZE at a time, so a small chunk of a heavily compressed file can't blow up in memory.
+    while chunk:
+        yield decompressor.decompress(chunk, CHUNK_SIZE)
+        chunk = decompressor.unconsumed_tail
+
+
+async def _references(url: str, filename: str):
+    """Yields (kind, id) for every entry of the file at url, in file order. """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if filename.endswith('.gz') else None
+    parser = None
+    total = 0
+    try:
+        async with app.get().session.get(url, timeout=aiohttp.ClientTimeout(total=None, sock_connect=DOWNLOAD_TIMEOUT, sock_read=DOWNLOAD_TIMEOUT)) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                try:
+                    pieces = list(_inflate(decompressor, chunk)) if decompressor is not None else [chunk]
+                except zlib.error:
+                    raise ValueError("The file isn't valid gzip.") from None
+                for data in pieces:
+                    total += len(data)
+                    if total > MAX_BYTES:
+                        raise ValueError(f"The file is bigger than {MAX_BYTES // 2 ** 20} MiB.")
+                    if parser is None:
+                        # The format is told apart by the first character: XML starts with '<', JSON Lines with '{'.
+                        data = data.lstrip(b'\xef\xbb\xbf \t\r\n')
+                        if not data:
+                            continue
+                        parser = _MALXML() if data.startswith(b'<') else _JSONLines()
+                    for reference in parser.feed(data):
+                        yield reference
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # An expired attachment link, a dropped connection or a stalled download.
+        raise ValueError("Couldn't download the file.") from None
+    if parser is not None:
+        for reference in parser.close():
+            yield reference
+
+
+async def _resolve(references: list, snapshots: dict):
+    """Looks up one batch of references and adds the snapshot of each match to snapshots. Returns (how many matched
+    nothing on AniList, AniList's error message if it failed for any of them, or None). """
+    anime_ids = [reference_id for kind, reference_id in references if kind == 'anilist']
+    mal_ids = [reference_id for kind, reference_id in references if kind == 'mal']
+    # Only the titles are kept, so cached anime are taken as they are, without refreshing their airing fields.
+    by_id, by_mal_id = await asyncio.gather(anilist.get_anime_many(anime_ids, ratelimit.BACKGROUND, volatile=False), anilist.get_anime_by_mal_ids(mal_ids, ratelimit.BACKGROUND))
+
+    unmatched = 0
+    error = None
+    for kind, reference_id in references:
+        anime = (by_id if kind == 'anilist' else by_mal_id).get(reference_id)
+        if isinstance(anime, list) and anime[0].get('status') != 404:
+            error = error or anime[0].get('message')
+            continue
+        if not isinstance(anime, models.Media):
+            unmatched += 1
+            continue
+        # An anime listed twice, e.g. once by each kind of id, keeps its first position.
+        snapshots.setdefault(anime.id, rewatch.snapshot(anime))
+    return unmatched, error
+
+
+async def import_list(user_id: int, url: str, filename: str) -> ImportResult:
+    """Adds every anime in the file at url (see the module docstring for the formats) to a user's list, in file order.
+    Raises ValueError if the file can't be read. If AniList fails, the entries matched so far are still added and
+    the result carries its error. """
+    snapshots = {}
+    seen = set()
+    batch = []
+    unmatched = 0
+    truncated = False
+    error = None
+    async with aclosing(_references(url, filename)) as references:
+        async for reference in references:
+            if reference in seen:
+                continue
+            if len(seen) == MAX_ENTRIES:
+                truncated = True
+                break
+            seen.add(reference)
+            batch.append(reference)
+            if len(batch) == anilist.BATCH_SIZE:
+                batch_unmatched, error = await _resolve(batch, snapshots)
+                unmatched += batch_unmatched
+                batch = []
+                if error is not None:
+                    break
+    if batch and error is None:
+        batch_unmatched, error = await _resolve(batch, snapshots)
+        unmatched += batch_unmatched
+
+    added = await rewatch.upsert_snapshots(user_id, list(snapshots.items()))
+    return ImportResult(added, len(snapshots), unmatched, truncated, error)
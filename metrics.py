@@ -0,0 +1,145 @@
+"""Counters and latency histograms for commands, UI callbacks, AniList requests, caches and MongoDB.
+
+Histograms keep cumulative bucket counts like Prometheus does, so memory stays fixed however much traffic comes in;
+quantiles are estimated from the buckets. render() writes every metric in the Prometheus text format and serve()
+exposes it over HTTP for scraping. """
+import bisect
+import functools
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from aiohttp import web
+
+# Upper bounds in seconds, from a cache hit to a request that hit its timeout.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+registry = []
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = defaultdict(float)
+        registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[_labels(labels)] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(labels)} {value}" for labels, value in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> [count per bucket (not cumulative), sum of observations]
+        self.series = {}
+        registry.append(self)
+
+    def observe(self, value: float, **labels):
+        series = self.series.get(_labels(labels))
+        if series is None:
+            series = self.series[_labels(labels)] = [[0] * len(self.buckets), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, labels: tuple) -> float:
+        """Estimates the q-quantile of one series by interpolating inside the bucket it falls in. """
+        counts = self.series[labels][0]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    # Nothing is known past the last finite bound.
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def summary(self) -> list:
+        """Returns (labels, count, p50, p95, p99) for every series. """
+        return [(labels, sum(series[0]), *(self.quantile(q, labels) for q in (0.5, 0.95, 0.99))) for labels, series in sorted(self.series.items())]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels, (('le', _format_bound(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+command_seconds = Histogram('command_seconds', "Time taken to handle a slash command.")
+command_errors = Counter('command_errors_total', "Slash commands that raised an error.")
+ui_callback_seconds = Histogram('ui_callback_seconds', "Time taken by select menu and button callbacks.")
+anilist_request_seconds = Histogram('anilist_request_seconds', "AniList GraphQL round trips, by query.")
+anilist_requests = Counter('anilist_requests_total', "AniList GraphQL responses, by query and HTTP status.")
+ratelimit_wait_seconds = Histogram('anilist_ratelimit_wait_seconds', "Time requests spent queued by the AniList rate limiter.")
+cache_lookups = Counter('cache_lookups_total', "Cache lookups, by cache and result (hit, stale or miss).")
+mongo_seconds = Histogram('mongo_op_seconds', "MongoDB operations, by operation.")
+anilist_failures = Counter('anilist_failures_total', "AniList calls given up on, by reason.")
+hedged_requests = Counter('anilist_hedged_requests_total', "Slow AniList reads that were sent a second time.")
+breaker_transitions = Counter('breaker_transitions_total', "Circuit breaker state changes, by breaker and new state.")
+
+
+def timed(histogram: Histogram, **labels):
+    """Decorates a coroutine function so every call is observed in `histogram`. """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+async def serve(host: str = '127.0.0.1', port: int = 9100) -> web.AppRunner:
+    """Starts serving render() at http://host:port/metrics. Call cleanup() on the returned runner to stop. """
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,58 @@
+"""One-shot migration from the old layout, one collection per Discord user in the "rewatch" database, to the single
+indexed rewatch_entries collection used by rewatch.py.
+
+    python migrate_rewatch.py          # copy every per-user collection
+    python migrate_rewatch.py --drop   # copy, then drop each per-user collection once it has been copied
+
+Re-running it is safe: entries are upserted on (user_id, anime_id), so nothing is duplicated. """
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import pymongo
+import app
+import rewatch
+
+BATCH_SIZE = 1000
+
+
+def migrate_user(name: str) -> int:
+    user_id = int(name)
+    now = datetime.now(timezone.utc)
+    operations = []
+    migrated = 0
+
+    for anime in app.get().db[name].find():
+        operations.append(pymongo.UpdateOne(
+            {"user_id": user_id, "anime_id": anime["_id"]},
+            {"$setOnInsert": {"name_romaji": anime["name_romaji"], "name_english": anime["name_english"], "link": anime["link"], "added_at": now}},
+            upsert=True,
+        ))
+        if len(operations) == BATCH_SIZE:
+            rewatch.collection().bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+
+    if operations:
+        rewatch.collection().bulk_write(operations, ordered=False)
+        migrated += len(operations)
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move per-user rewatch collections into rewatch_entries.")
+    parser.add_argument("--drop", action="store_true", help="drop each per-user collection after it has been copied")
+    args = parser.parse_args()
+
+    asyncio.run(rewatch.ensure_indexes())
+    for name in app.get().db.list_collection_names():
+        # The old collections are named after the user's Discord id.
+        if not name.isdigit():
+            continue
+        migrated = migrate_user(name)
+        print(f"{name}: {migrated} entries")
+        if args.drop:
+            app.get().db.drop_collection(name)
+
+
+if __name__ == "__main__":
+    main()
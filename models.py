@@ -0,0 +1,223 @@
+"""Typed records built straight from AniList's GraphQL JSON.
+
+They are frozen, slotted dataclasses: cheap to keep by the thousand in the caches, safe to share between callers
+without copying, and missing values stay None instead of a display string. to_json()/from_json() convert them to and
+from plain JSON for the persistent cache. """
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+def _date(date: dict) -> Optional[str]:
+    """Formats an AniList FuzzyDate as day/month/year, leaving out unknown parts. None if nothing is known. """
+    parts = [str(date[part]) for part in ('day', 'month', 'year') if date[part] is not None]
+    return '/'.join(parts) or None
+
+
+@dataclass(frozen=True, slots=True)
+class NextEpisode:
+    airing_at: int
+    time_until_airing: int
+    episode: int
+
+    @classmethod
+    def from_graphql(cls, data: Optional[dict]) -> Optional['NextEpisode']:
+        if data is None:
+            return None
+        return cls(data['airingAt'], data['timeUntilAiring'], data['episode'])
+
+
+@dataclass(frozen=True, slots=True)
+class Media:
+    id: int
+    name_romaji: str
+    name_english: Optional[str]
+    synonyms: tuple
+    start_date: Optional[str]
+    end_date: Optional[str]
+    cover_image: Optional[str]
+    banner_image: Optional[str]
+    cover_color: Optional[str]
+    airing_format: Optional[str]
+    airing_status: Optional[str]
+    airing_episodes: Optional[int]
+    next_airing_episode: Optional[NextEpisode]
+    season: Optional[str]
+    episode_duration: Optional[int]
+    description: Optional[str]
+    average_score: Optional[int]
+    genres: tuple
+    is_adult: bool
+    origin_country: Optional[str]
+    site_url: str
+    trailer_url: Optional[str]
+
+    @staticmethod
+    def volatile_from_graphql(data: dict) -> dict:
+        """The fields that change as a show airs, as the keyword arguments for dataclasses.replace(). """
+        return {
+            'airing_status': data['status'].replace('_', ' ').title() if data['status'] is not None else None,
+            'next_airing_episode': NextEpisode.from_graphql(data['nextAiringEpisode']),
+            'average_score': data['averageScore'],
+        }
+
+    @staticmethod
+    def volatile_to_json(fields: dict) -> dict:
+        next_episode = fields['next_airing_episode']
+        return {**fields, 'next_airing_episode': asdict(next_episode) if next_episode is not None else None}
+
+    @staticmethod
+    def volatile_from_json(data: dict) -> dict:
+        next_episode = data['next_airing_episode']
+        return {**data, 'next_airing_episode': NextEpisode(**next_episode) if next_episode is not None else None}
+
+    @classmethod
+    def from_graphql(cls, data: dict) -> 'Media':
+        """Builds a Media from a Media object selected with the MediaFull fragment. """
+        trailer = data['trailer']
+        if trailer is None:
+            trailer_url = None
+        elif trailer['site'] == 'youtube':
+            trailer_url = f"https://youtube.com/watch?v={trailer['id']}"
+        else:
+            trailer_url = f"https://dailymotion.com/video/{trailer['id']}"
+
+        return cls(
+            id=data['id'],
+            name_romaji=data['title']['romaji'],
+            name_english=data['title']['english'],
+            synonyms=tuple(data['synonyms'] or ()),
+            start_date=_date(data['startDate']),
+            end_date=_date(data['endDate']),
+            cover_image=data['coverImage']['large'],
+            banner_image=data['bannerImage'],
+            cover_color=data['coverImage']['color'],
+            airing_format=data['format'],
+            airing_episodes=data['episodes'],
+            season=data['season'],
+            episode_duration=data['duration'],
+            description=data['description'],
+            genres=tuple(data['genres'] or ()),
+            is_adult=data['isAdult'],
+            origin_country=data['countryOfOrigin'].lower() if data['countryOfOrigin'] is not None else None,
+            site_url=data['siteUrl'],
+            trailer_url=trailer_url,
+            **cls.volatile_from_graphql(data),
+        )
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Media':
+        return cls(**{**cls.volatile_from_json(data), 'synonyms': tuple(data['synonyms']), 'genres': tuple(data['genres'])})
+
+
+@dataclass(frozen=True, slots=True)
+class AiringInfo:
+    """What get_next_airing_episode() returns: an anime's titles and its next episode, if one is scheduled. """
+    id: int
+    name_romaji: str
+    name_english: Optional[str]
+    episodes: Optional[int]
+    next_airing_episode: Optional[NextEpisode]
+
+    @classmethod
+    def from_graphql(cls, data: dict) -> 'AiringInfo':
+        return cls(data['id'], data['title']['romaji'], data['title']['english'], data['episodes'], NextEpisode.from_graphql(data['nextAiringEpisode']))
+
+
+@dataclass(frozen=True, slots=True)
+class MediaTitle:
+    """What get_titles_many() returns: only an anime's titles and AniList link. """
+    id: int
+    name_romaji: str
+    name_english: Optional[str]
+    site_url: str
+
+    @classmethod
+    def from_graphql(cls, data: dict) -> 'MediaTitle':
+        return cls(data['id'], data['title']['romaji'], data['title']['english'], data['siteUrl'])
+
+
+@dataclass(frozen=True, slots=True)
+class Character:
+    id: int
+    name: str
+    alt_names: tuple
+    description: Optional[str]
+    gender: Optional[str]
+    age: Optional[str]
+    site_url: str
+    birthdate: Optional[str]
+    # (type, name_romaji, name_english) for every media the character appears in, most popular first.
+    appears_in: tuple
+    image: Optional[str]
+
+    @classmethod
+    def from_graphql(cls, data: dict) -> 'Character':
+        """Builds a Character from a Character object selected with the CharacterFull fragment. """
+        appears_in = tuple((edge['node']['type'].lower(), edge['node']['title']['romaji'], edge['node']['title']['english']) for edge in data['media']['edges'])
+        return cls(
+            id=data['id'],
+            name=data['name']['full'],
+            alt_names=tuple(name for name in data['name']['alternative'] or () if name),
+            description=data['description'],
+            gender=data['gender'],
+            age=data['age'],
+            site_url=data['siteUrl'],
+            birthdate=_date(data['dateOfBirth']),
+            appears_in=appears_in,
+            image=data['image']['large'],
+        )
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Character':
+        return cls(**{**data, 'alt_names': tuple(data['alt_names']), 'appears_in': tuple(map(tuple, data['appears_in']))})
+
+
+@dataclass(frozen=True, slots=True)
+class SearchResult:
+    id: int
+    # What the select menu shows: the title (or character name), and the English title (or the character's best
+    # known appearance) underneath.
+    label: str
+    description: Optional[str]
+    gender: Optional[str] = None
+
+
+@dataclass(frozen=True, slots=True)
+class SearchPage:
+    """One page of anime or character search results. """
+    kind: str
+    current_page: int
+    last_page: int
+    has_next_page: bool
+    total: int
+    results: tuple
+
+    @classmethod
+    def from_media_page(cls, data: dict) -> 'SearchPage':
+        results = tuple(SearchResult(media['id'], media['title']['romaji'], media['title']['english']) for media in data['media'])
+        return cls._from_page('anime', data['pageInfo'], results)
+
+    @classmethod
+    def from_character_page(cls, data: dict) -> 'SearchPage':
+        results = []
+        for character in data['characters']:
+            edges = character['media']['edges']
+            results.append(SearchResult(character['id'], character['name']['full'], edges[0]['node']['title']['romaji'] if edges else None, character['gender']))
+        return cls._from_page('character', data['pageInfo'], tuple(results))
+
+    @classmethod
+    def _from_page(cls, kind: str, page_info: dict, results: tuple) -> 'SearchPage':
+        return cls(kind, page_info['currentPage'], page_info['lastPage'], page_info['hasNextPage'], page_info['total'], results)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'SearchPage':
+        return cls(**{**data, 'results': tuple(SearchResult(**result) for result in data['results'])})
@@ -0,0 +1,252 @@
+"""Every GraphQL document anilist.py sends, built once at import time.
+
+Field selections shared between queries are written once as fragments, and each document only carries the fragments
+it uses. Documents are minified and given a SHA-256 content hash, which identifies a query (e.g. for request
+coalescing or persisted-query style caching) without comparing the whole text. """
+import hashlib
+import re
+from typing import NamedTuple
+
+FRAGMENTS = {
+    'MediaTitle': """
+        fragment MediaTitle on Media {
+            id
+            title {
+                romaji
+                english
+            }
+        }
+    """,
+    'NextEpisode': """
+        fragment NextEpisode on Media {
+            nextAiringEpisode {
+                airingAt
+                timeUntilAiring
+                episode
+            }
+        }
+    """,
+    'FuzzyDates': """
+        fragment FuzzyDates on Media {
+            startDate {
+                year
+                month
+                day
+            }
+            endDate {
+                year
+                month
+                day
+            }
+        }
+    """,
+    # Every field get_anime() needs.
+    'MediaFull': """
+        fragment MediaFull on Media {
+            ...MediaTitle
+            ...FuzzyDates
+            ...NextEpisode
+            synonyms
+            coverImage {
+                large
+                color
+            }
+            bannerImage
+            format
+            status
+            episodes
+            duration
+            season
+            description
+            averageScore
+            genres
+            isAdult
+            countryOfOrigin
+            siteUrl
+            trailer {
+                id
+                site
+            }
+        }
+    """,
+    # Every field get_character() needs.
+    'CharacterFull': """
+        fragment CharacterFull on Character {
+            id
+            name {
+                full
+                alternative
+            }
+            image {
+                large
+            }
+            description (asHtml: false)
+            dateOfBirth {
+                year
+                month
+                day
+            }
+            gender
+            age
+            siteUrl
+            media (sort: POPULARITY_DESC) {
+                edges {
+                    node {
+                        title {
+                            romaji
+                            english
+                        }
+                        type
+                    }
+                }
+            }
+        }
+    """,
+    'PageInfo': """
+        fragment PageInfo on PageInfo {
+            total
+            currentPage
+            lastPage
+            hasNextPage
+        }
+    """,
+}
+
+_SPREAD = re.compile(r'\.\.\.\s*(\w+)')
+_WHITESPACE = re.compile(r'\s+')
+_PUNCTUATION = re.compile(r'\s*([{}()\[\]:,!=@$]|\.\.\.)\s*')
+
+
+class Query(NamedTuple):
+    name: str
+    text: str
+    sha256: str
+
+
+def minify(document: str) -> str:
+    """Drops every bit of whitespace GraphQL doesn't need: indentation, newlines and spaces around punctuation. """
+    return _PUNCTUATION.sub(r'\1', _WHITESPACE.sub(' ', document)).strip()
+
+
+def _fragments_used(text: str, found: list) -> list:
+    for name in _SPREAD.findall(text):
+        if name in FRAGMENTS and name not in found:
+            found.append(name)
+            _fragments_used(FRAGMENTS[name], found)
+    return found
+
+
+def build(name: str, operation: str) -> Query:
+    """Appends the fragments an operation spreads (and the ones they spread), minifies it and hashes the result. """
+    document = minify(' '.join([operation] + [FRAGMENTS[fragment] for fragment in _fragments_used(operation, [])]))
+    return Query(name, document, hashlib.sha256(document.encode()).hexdigest())
+
+
+SEARCH_MEDIA = build('SearchMedia', """
+    query ($search: String, $id: Int, $page: Int, $perPage: Int, $status: MediaStatus, $full: Boolean!) {
+        Page (page: $page, perPage: $perPage) {
+            pageInfo {
+                ...PageInfo
+            }
+            media (search: $search, type: ANIME, id: $id, status: $status) {
+                ...MediaTitle
+                ...MediaFull @include(if: $full)
+            }
+        }
+    }
+""")
+
+MEDIA_BY_IDS = build('MediaByIds', """
+    query ($ids: [Int], $perPage: Int) {
+        Page (perPage: $perPage) {
+            media (id_in: $ids, type: ANIME) {
+                ...MediaFull
+            }
+        }
+    }
+""")
+
+# Only titles and links, for keeping the snapshots stored in rewatch entries current (see refresh.py).
+TITLES_BY_IDS = build('TitlesByIds', """
+    query ($ids: [Int], $perPage: Int) {
+        Page (perPage: $perPage) {
+            media (id_in: $ids, type: ANIME) {
+                ...MediaTitle
+                siteUrl
+            }
+        }
+    }
+""")
+
+# For imports from MyAnimeList, whose lists identify anime by MyAnimeList id.
+MEDIA_BY_MAL_IDS = build('MediaByMalIds', """
+    query ($ids: [Int], $perPage: Int) {
+        Page (perPage: $perPage) {
+            media (idMal_in: $ids, type: ANIME) {
+                idMal
+                ...MediaFull
+            }
+        }
+    }
+""")
+
+# Only the fields that go stale quickly, for refreshing cached anime and airing schedules.
+AIRING_BY_IDS = build('AiringByIds', """
+    query ($ids: [Int], $perPage: Int) {
+        Page (perPage: $perPage) {
+            media (id_in: $ids, type: ANIME) {
+                id
+                status
+                averageScore
+                ...NextEpisode
+            }
+        }
+    }
+""")
+
+NEXT_AIRING = build('NextAiring', """
+    query ($id: Int) {
+        Media (type: ANIME, id: $id) {
+            ...MediaTitle
+            ...NextEpisode
+            episodes
+        }
+    }
+""")
+
+CHARACTERS_BY_IDS = build('CharactersByIds', """
+    query ($ids: [Int], $perPage: Int) {
+        Page (perPage: $perPage) {
+            characters (id_in: $ids) {
+                ...CharacterFull
+            }
+        }
+    }
+""")
+
+SEARCH_CHARACTERS = build('SearchCharacters', """
+    query ($name: String, $id: Int, $page: Int, $perPage: Int) {
+        Page (page: $page, perPage: $perPage) {
+            pageInfo {
+                ...PageInfo
+            }
+            characters (search: $name, id: $id) {
+                id
+                name {
+                    full
+                }
+                gender
+                media {
+                    edges {
+                        node {
+                            title {
+                                english
+                                romaji
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+""")
@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+
+# Lower values are served first. Interactive lookups are someone waiting on a select menu or command;
+# background work (cache refreshes, prefetching, list refreshes) only gets tokens nobody interactive is queued for.
+INTERACTIVE = 0
+BACKGROUND = 10
+
+
+class SharedBudget:
+    """A token bucket kept in a SQLite file, so every process on the machine draws from the same AniList budget.
+
+    AniList counts requests per IP, so shards running as separate processes have to split one budget between them.
+    The bucket is a single row updated inside an IMMEDIATE transaction, which SQLite serialises across processes.
+    Times are wall-clock because the processes share no monotonic clock. Calls block on the file lock, so the event
+    loop makes them through asyncio.to_thread(). """
+
+    def __init__(self, path: str, rate: int = 90, per: float = 60.0):
+        self.path = path
+        self.per = per
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS budget (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                rate REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                blocked_until REAL NOT NULL
+            )
+        """)
+        connection.execute("INSERT OR IGNORE INTO budget VALUES (0, ?, ?, ?, 0)", (rate, rate, time.time()))
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit mode, so transactions are only the ones begun explicitly below.
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self, change):
+        """Runs change(rate, tokens, now, blocked_until) on the refilled bucket; it returns the new
+        (rate, tokens, blocked_until) and a result to hand back. """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rate, tokens, updated, blocked_until = connection.execute("SELECT rate, tokens, updated, blocked_until FROM budget").fetchone()
+            now = time.time()
+            tokens = min(rate, tokens + max(0.0, now - updated) * rate / self.per)
+            (rate, tokens, blocked_until), result = change(rate, tokens, now, blocked_until)
+            connection.execute("UPDATE budget SET rate = ?, tokens = ?, updated = ?, blocked_until = ?", (rate, tokens, now, blocked_until))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    def take(self) -> float:
+        """Takes a token and returns 0, or returns how many seconds to wait before one is available. """
+        def change(rate, tokens, now, blocked_until):
+            if blocked_until > now:
+                return (rate, tokens, blocked_until), blocked_until - now
+            if tokens < 1:
+                return (rate, tokens, blocked_until), (1 - tokens) * self.per / rate
+            return (rate, tokens - 1, blocked_until), 0.0
+
+        return self._transaction(change)
+
+    def update(self, rate: int = None, remaining: float = None, retry_after: float = None):
+        """Folds what one process learned from AniList's headers into the shared bucket, see RateLimiter.update(). """
+        def change(current_rate, tokens, now, blocked_until):
+            if rate is not None:
+                current_rate, tokens = rate, min(tokens, rate)
+            if remaining is not None:
+                tokens = min(tokens, remaining)
+            if retry_after is not None:
+                tokens, blocked_until = 0.0, max(blocked_until, now + retry_after)
+            return (current_rate, tokens, blocked_until), None
+
+        self._transaction(change)
+
+
+class RateLimiter:
+    """Token bucket shared by every AniList request, with a priority queue of waiters.
+
+    The bucket holds `rate` tokens and refills continuously over `per` seconds. The server's own view of the budget is
+    folded in through update(), which reads the X-RateLimit-* headers and blocks all waiters for Retry-After on a 429.
+
+    When several processes share the AniList quota, `shared` is set to a SharedBudget and every request also has to
+    take a token from it. The local bucket still decides which waiter goes next. """
+
+    def __init__(self, rate: int = 90, per: float = 60.0, shared: SharedBudget = None):
+        self.rate = rate
+        self.per = per
+        self.shared = shared
+        self.tokens = float(rate)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._counter = itertools.count()
+        self._dispatcher = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        """Waits until a request of the given priority may be sent. """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            delay = self.blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+                continue
+
+            if self._waiters[0][2].done():
+                # The waiter gave up (its interaction was cancelled), so the token stays in the bucket.
+                heapq.heappop(self._waiters)
+                continue
+            if self.shared is not None:
+                delay = await asyncio.to_thread(self.shared.take)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            self.tokens -= 1
+            if not future.done():
+                future.set_result(None)
+
+    def update(self, status: int, headers):
+        """Adjusts the bucket from an AniList response's status code and rate limit headers. """
+        limit = headers.get('X-RateLimit-Limit')
+        changed_rate = None
+        if limit is not None and int(limit) != self.rate:
+            # AniList lowers the per-minute limit while degraded.
+            self.rate = changed_rate = int(limit)
+            self.tokens = min(self.tokens, self.rate)
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            remaining = float(remaining)
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+
+        retry_after = None
+        if status == 429:
+            retry_after = headers.get('Retry-After')
+            retry_after = float(retry_after) if retry_after is not None else self.per
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.tokens = 0.0
+
+        if self.shared is not None:
+            # Written in the background; nothing here needs to wait for the other processes to see it.
+            asyncio.get_running_loop().run_in_executor(None, self.shared.update, changed_rate, remaining, retry_after)
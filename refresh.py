@@ -0,0 +1,129 @@
+"""Keeps the title snapshots stored in rewatch entries (name_romaji, name_english and link) up to date.
+
+A run walks every distinct anime on anyone's list in id order, PAGE_SIZE at a time, straight off a MongoDB cursor.
+Only the titles of each page are fetched from AniList, with one id_in query that bypasses the caches, and compared
+with the snapshots already stored. Only the entries whose snapshot changed are rewritten, in one bulk write per page.
+The last id of every finished page is checkpointed in MongoDB, so a run cut short by a restart carries on from there
+instead of starting over. """
+import asyncio
+import itertools
+from datetime import datetime, timezone
+import pymongo
+import anilist
+import database
+import models
+import ratelimit
+import rewatch
+
+# One id_in query's worth of anime.
+PAGE_SIZE = anilist.BATCH_SIZE
+# How long after one run finishes the next one starts.
+INTERVAL = 24 * 60 * 60
+# How long to wait before resuming a run that failed part way, e.g. during an AniList outage.
+RETRY_DELAY = 10 * 60
+CHECKPOINT_ID = "rewatch_titles"
+
+
+# One document per background job, holding how far its current run got.
+def checkpoints():
+    return database.collection("refresh_checkpoints")
+
+
+async def _pages(after: int = None):
+    """Yields pages of {"_id": anime_id, "snapshots": [every distinct snapshot stored for it]}, for every anime after
+    `after`, in id order. """
+    pipeline = [
+        {"$match": {"anime_id": {"$gt": after}} if after is not None else {}},
+        # Sorted before grouping so the match and the group can read the anime_id index in order.
+        {"$sort": {"anime_id": pymongo.ASCENDING}},
+        {"$group": {"_id": "$anime_id", "snapshots": {"$addToSet": {"name_romaji": "$name_romaji", "name_english": "$name_english", "link": "$link"}}}},
+        {"$sort": {"_id": pymongo.ASCENDING}},
+    ]
+    cursor = await database.run(rewatch.collection().aggregate, pipeline, allowDiskUse=True, batchSize=PAGE_SIZE)
+    try:
+        while True:
+            page = await database.run(lambda: list(itertools.islice(cursor, PAGE_SIZE)))
+            if not page:
+                return
+            yield page
+    finally:
+        cursor.close()
+
+
+def _changes(page: list, fetched: dict) -> list:
+    """Returns an update for every anime in the page whose stored snapshots differ from what AniList has now. """
+    operations = []
+    for group in page:
+        anime = fetched.get(group["_id"])
+        if not isinstance(anime, models.MediaTitle):
+            # Gone from AniList; the entries keep their last snapshot.
+            continue
+        snapshot = rewatch.snapshot(anime)
+        if all(stored == snapshot for stored in group["snapshots"]):
+            continue
+        # The filter leaves out entries that are already current, so only changed documents are written.
+        operations.append(pymongo.UpdateMany(
+            {"anime_id": anime.id, "$or": [{field: {"$ne": value}} for field, value in snapshot.items()]},
+            {"$set": snapshot},
+        ))
+    return operations
+
+
+async def _checkpoint(**fields):
+    await database.run(checkpoints().update_one, {"_id": CHECKPOINT_ID}, {"$set": {**fields, "updated_at": datetime.now(timezone.utc)}}, upsert=True)
+
+
+async def run(after: int = None) -> int:
+    """Refreshes the snapshots of every anime after `after` (all of them by default), checkpointing as it goes.
+    Returns how many entries were rewritten. Raises if AniList fails, leaving the checkpoint at the last full page. """
+    rewritten = 0
+    async for page in _pages(after):
+        anime_ids = [group["_id"] for group in page]
+        fetched = await anilist.get_titles_many(anime_ids, ratelimit.BACKGROUND)
+        errors = [result[0] for result in fetched.values() if isinstance(result, list) and result[0].get('status') != 404]
+        if errors:
+            raise RuntimeError(f"AniList error: {errors[0].get('message')}")
+
+        operations = _changes(page, fetched)
+        if operations:
+            result = await database.run(rewatch.collection().bulk_write, operations, ordered=False)
+            rewritten += result.modified_count
+        await _checkpoint(after=anime_ids[-1])
+
+    await _checkpoint(after=None, finished_at=datetime.now(timezone.utc))
+    return rewritten
+
+
+class TitleRefresher:
+    """Runs a refresh every INTERVAL, resuming an unfinished one first. """
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            checkpoint = await database.run(checkpoints().find_one, {"_id": CHECKPOINT_ID}) or {}
+            after, finished_at = checkpoint.get("after"), checkpoint.get("finished_at")
+            if after is None and finished_at is not None:
+                # pymongo hands datetimes back without a timezone; they are UTC.
+                elapsed = (datetime.now(timezone.utc) - finished_at.replace(tzinfo=timezone.utc)).total_seconds()
+                if elapsed < INTERVAL:
+                    await asyncio.sleep(INTERVAL - elapsed)
+                    continue
+            try:
+                rewritten = await run(after)
+                print(f"Title refresh finished, {rewritten} entries updated.")
+            except Exception as e:
+                print(f"Title refresh failed, resuming in {RETRY_DELAY}s: {e!r}")
+                await asyncio.sleep(RETRY_DELAY)
+
+
+# The running refresher, created by the bot on start up in the same process as airing.scheduler.
+refresher = None
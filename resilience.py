@@ -0,0 +1,187 @@
+"""Keeping calls to a slow or failing upstream bounded: deadlines, jittered retries, hedging and a circuit breaker.
+
+A deadline is set once per interaction (see utility.start_deadline) in a context variable, so every call made while
+handling it, however deep, can ask how long it has left with remaining() instead of having a timeout threaded through.
+Tasks started from there inherit it, except shared work (batches, single-flight calls, cache refreshes, prefetches),
+which is started with detach() so it has none: each waiter on it applies its own deadline with within_deadline()
+instead. Code running outside any interaction has none either. """
+import asyncio
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+import metrics
+
+# The time.monotonic() by which the current interaction's work has to be done, or None.
+_deadline = contextvars.ContextVar('deadline', default=None)
+# Tasks started by detach() that haven't finished yet.
+_detached = set()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def set_deadline(seconds: float):
+    """Gives the rest of the current task `seconds` to finish. """
+    _deadline.set(time.monotonic() + seconds)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Tightens the deadline to `seconds` from now for the duration of the block. It is never loosened. """
+    current = _deadline.get()
+    token = _deadline.set(time.monotonic() + seconds if current is None else min(current, time.monotonic() + seconds))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def no_deadline():
+    """Lifts the deadline for the duration of the block, for bulk work a user has agreed to wait on (e.g. an import)
+    that is bounded some other way. """
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def detach(coroutine) -> asyncio.Task:
+    """Starts coroutine as a task with no deadline, for work shared by several callers or outliving the one that
+    started it. It would otherwise run under (and fail with) the deadline of whichever caller happened to start it. """
+    task = asyncio.create_task(coroutine, context=contextvars.Context())
+    _detached.add(task)
+    task.add_done_callback(_detached.discard)
+    return task
+
+
+async def cancel_detached():
+    """Cancels every task started by detach() that is still running and waits for them, e.g. before shutting down. """
+    while _detached:
+        tasks = list(_detached)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def remaining():
+    """Seconds left before the deadline, or None when there is none. """
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+def timeout(default: float) -> float:
+    """`default`, cut short to what is left of the deadline. Raises DeadlineExceeded once it has passed. """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(default, left)
+
+
+async def within_deadline(awaitable):
+    """Awaits `awaitable`, giving up with DeadlineExceeded when the deadline passes first. """
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(left, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """"Full jitter" backoff: a random delay up to base * 2 ** attempt, so retries from many callers spread out
+    instead of arriving together. """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def retry(call, attempts: int, retry_on: tuple, base: float = 0.2, cap: float = 2.0):
+    """Awaits call() up to `attempts` times while it raises one of `retry_on`, sleeping backoff() in between. Stops
+    early, raising the last error, when the next attempt couldn't start before the deadline. """
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except retry_on:
+            delay = backoff(attempt, base, cap)
+            left = remaining()
+            if attempt == attempts - 1 or (left is not None and delay >= left):
+                raise
+            await asyncio.sleep(delay)
+
+
+async def hedge(call, after: float):
+    """Awaits call(), and if it hasn't finished after `after` seconds, a second call() alongside it. The first to
+    succeed wins and the other is cancelled. If both fail, the first call's error is raised. Only for reads, since
+    the request may be sent twice. """
+    first = asyncio.ensure_future(call())
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=after)
+        if done:
+            return first.result()
+        metrics.hedged_requests.inc()
+        tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    return task.result()
+        return first.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing, so callers get an answer (stale, or an error) straight away.
+
+    Closed, calls go through and consecutive failures are counted. At `threshold` the breaker opens and allow()
+    refuses everything for `reset_after` seconds. Then it is half open: one call is let through as a probe, and its
+    outcome closes the breaker again or reopens it. """
+
+    def __init__(self, name: str, threshold: int = 5, reset_after: float = 30.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def _transition(self, state: str):
+        if state != self.state:
+            self.state = state
+            metrics.breaker_transitions.inc(breaker=self.name, state=state)
+
+    def allow(self) -> bool:
+        if self.state == 'open':
+            if time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            self._transition('half_open')
+        if self.state == 'half_open':
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        self._probing = False
+        self.failures = 0
+        self._transition('closed')
+
+    def record_failure(self):
+        self._probing = False
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+            self._transition('open')
+
+    def release(self):
+        """Gives up a probe that ended without telling anything about the upstream, e.g. it was cancelled. """
+        self._probing = False
@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+import pymongo
+import database
+import models
+
+# Every user's rewatch list lives in this one collection, one document per (user, anime).
+def collection():
+    return database.collection("rewatch_entries")
+
+
+DEFAULT_PROJECTION = {"_id": 0, "anime_id": 1, "name_romaji": 1, "name_english": 1, "link": 1}
+# Entries per /rw page. Sized so a full page of long titles still fits in one embed description.
+PAGE_SIZE = 15
+
+
+async def ensure_indexes():
+    """Creates the (user_id, anime_id) index every query here relies on. Safe to call on every start up. """
+    await database.run(collection().create_index, [("user_id", pymongo.ASCENDING), ("anime_id", pymongo.ASCENDING)], unique=True, name="user_anime")
+    # Lists are read in insertion order, which is _id order, so pages can be walked with a range on _id.
+    await database.run(collection().create_index, [("user_id", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], name="user_order")
+    # For walking the distinct anime on everyone's lists, and rewriting every entry of one anime, see refresh.py.
+    await database.run(collection().create_index, [("anime_id", pymongo.ASCENDING)], name="anime")
+
+
+def snapshot(anime) -> dict:
+    """The fields of an anime (a models.Media or models.MediaTitle) copied into each entry, so a list can be shown
+    without asking AniList. """
+    return {"name_romaji": anime.name_romaji, "name_english": anime.name_english, "link": anime.site_url}
+
+
+async def list_page(user_id: int, after=None, limit: int = PAGE_SIZE):
+    """Returns (entries, has_next) for one page of a user's list, starting after the entry whose _id is `after`.
+    Pages are read with a range on the (user_id, _id) index, so every page costs the same however long the list is. """
+    query = {"user_id": user_id}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+
+    rewatch_entries = collection()
+
+    def find():
+        return list(rewatch_entries.find(query, {**DEFAULT_PROJECTION, "_id": 1}).sort("_id", pymongo.ASCENDING).limit(limit + 1))
+
+    entries = await database.run(find)
+    return entries[:limit], len(entries) > limit
+
+
+async def count_entries(user_id: int) -> int:
+    return await database.run(collection().count_documents, {"user_id": user_id})
+
+
+async def add_entry(user_id: int, anime: models.Media) -> bool:
+    """Adds an anime (a models.Media, as returned by anilist.get_anime()) to a user's list. Returns False if it was already on it. """
+    result = await database.run(
+        collection().update_one,
+        {"user_id": user_id, "anime_id": anime.id},
+        {"$setOnInsert": {**snapshot(anime), "added_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    return result.upserted_id is not None
+
+
+async def remove_entry(user_id: int, anime_id: int):
+    """Removes an anime from a user's list, returning the removed entry, or None if it wasn't on the list. """
+    return await database.run(collection().find_one_and_delete, {"user_id": user_id, "anime_id": anime_id})
+
+
+async def bulk_upsert(user_id: int, animes: list) -> int:
+    """Adds many anime to a user's list in one round trip, refreshing the stored titles of any already on it.
+    Returns how many were new. """
+    return await upsert_snapshots(user_id, [(anime.id, snapshot(anime)) for anime in animes])
+
+
+async def upsert_snapshots(user_id: int, snapshots: list) -> int:
+    """bulk_upsert() for (anime_id, snapshot()) pairs, for callers that don't keep the models.Media around. The
+    write is ordered, so new entries keep the order they were given in. Returns how many were new. """
+    if not snapshots:
+        return 0
+    now = datetime.now(timezone.utc)
+    operations = [
+        pymongo.UpdateOne({"user_id": user_id, "anime_id": anime_id}, {"$set": fields, "$setOnInsert": {"added_at": now}}, upsert=True)
+        for anime_id, fields in snapshots
+    ]
+    result = await database.run(collection().bulk_write, operations, ordered=True)
+    return result.upserted_count
@@ -0,0 +1,76 @@
+import re
+from collections import OrderedDict
+
+# Discord embed field values are capped at 1024 characters.
+MAXLEN = 1024
+
+# Discord markdown that comes in pairs. Longer tokens come first so "**" isn't read as two "*".
+_PAIRED = re.compile(r'\|\||\*\*|~~|__|\*|`')
+
+
+def truncate(text: str, limit: int = MAXLEN, ellipsis: str = '...') -> str:
+    """Cuts text to at most `limit` characters, ending in `ellipsis`. The cut never lands inside a markdown token,
+    prefers a word boundary, and closes every pair (spoilers, bold, ...) still open at that point, so a spoiler can't
+    leak into the rest of the embed. """
+    if len(text) <= limit:
+        return text
+
+    budget = limit - len(ellipsis)
+    best_cut, best_open = 0, []
+    open_tokens = []
+    start = 0
+    for match in [*_PAIRED.finditer(text), None]:
+        end = match.start() if match is not None else len(text)
+        # Anywhere in text[start:end] is a safe cut, as long as the closing tokens still fit.
+        cut = min(end, budget - sum(map(len, open_tokens)))
+        if cut >= start:
+            space = text.rfind(' ', start, cut)
+            best_cut, best_open = (space if space > start and cut < end else cut), list(open_tokens)
+        if match is None or start > budget:
+            break
+        token = match.group()
+        if token in open_tokens:
+            open_tokens.remove(token)
+        else:
+            open_tokens.append(token)
+        start = match.end()
+
+    return text[:best_cut].rstrip() + ''.join(reversed(best_open)) + ellipsis
+
+
+class Sanitizer:
+    """Turns AniList's HTML/markdown into Discord markdown and fits it into an embed field.
+
+    Every rule is applied in one regex pass over the text. Results are memoized per key, e.g. (entity id, field),
+    so a cached record is only sanitized the first time it is shown, or again once its text changes. """
+
+    def __init__(self, rules: dict, max_entries: int = 4096):
+        self.rules = rules
+        self.max_entries = max_entries
+        self._pattern = re.compile('|'.join(map(re.escape, sorted(rules, key=len, reverse=True))))
+        self._memo = OrderedDict()
+
+    def convert(self, text: str) -> str:
+        return self._pattern.sub(lambda match: self.rules[match.group()], text)
+
+    def __call__(self, text: str, key=None, limit: int = MAXLEN) -> str:
+        if key is None:
+            return truncate(self.convert(text), limit)
+
+        memo = self._memo.get(key)
+        if memo is not None and memo[0] == text and memo[1] == limit:
+            self._memo.move_to_end(key)
+            return memo[2]
+
+        result = truncate(self.convert(text), limit)
+        self._memo[key] = (text, limit, result)
+        self._memo.move_to_end(key)
+        if len(self._memo) > self.max_entries:
+            self._memo.popitem(last=False)
+        return result
+
+
+# Anime descriptions are HTML; line breaks already come with a newline, and italics become markdown.
+anime = Sanitizer({'<br>': '', '<i>': '*', '</i>': '*'})
+# Character descriptions use AniList's markdown: __bold__ and ~!spoilers!~.
+characters = Sanitizer({'~!': '||', '!~': '||', '__': '**', '_': '*', '!': '', '~': '||'})
@@ -0,0 +1,130 @@
+import bisect
+import heapq
+import json
+import re
+from collections import Counter, defaultdict
+
+_NON_WORD = re.compile(r'[\W_]+')
+# Bounds on the work one fuzzy lookup does: ids counted while gathering candidates, and candidates then scored.
+MAX_SCANNED = 1000
+MAX_CANDIDATES = 100
+
+
+def normalize(name: str) -> str:
+    """Case-folds a title and collapses punctuation and spacing, so "Re:Zero" and "re zero" compare equal. """
+    return _NON_WORD.sub(' ', name.casefold()).strip()
+
+
+def _trigrams(name: str) -> set:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """In-memory index of names (titles, synonyms or character names) for autocomplete and exact lookups.
+
+    Prefix matches come from a sorted list of normalised names searched with bisect; fuzzy matches from an inverted
+    index of character trigrams, ranked by how many trigrams a name shares with the query. """
+
+    def __init__(self):
+        self.labels = {}
+        self._sorted = []
+        self._exact = defaultdict(set)
+        self._grams = defaultdict(set)
+        self._names = defaultdict(set)
+        self._shortest = {}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def add(self, entity_id: int, names: list, label: str = None):
+        """Indexes an entity under each of its names. label is what autocomplete shows, defaulting to the first name. """
+        names = [name for name in names if name]
+        if not names:
+            return
+        self.labels[entity_id] = label or names[0]
+        for name in names:
+            key = normalize(name)
+            if not key or key in self._names[entity_id]:
+                continue
+            self._names[entity_id].add(key)
+            self._shortest[entity_id] = min(len(key), self._shortest.get(entity_id, len(key)))
+            self._exact[key].add(entity_id)
+            bisect.insort(self._sorted, (key, entity_id))
+            for gram in _trigrams(key):
+                self._grams[gram].add(entity_id)
+
+    def exact(self, name: str) -> set:
+        """Ids of every entity with a name equal to `name` once normalised. """
+        return self._exact.get(normalize(name), set())
+
+    def prefix(self, text: str, limit: int = 25) -> list:
+        key = normalize(text)
+        results = []
+        start = bisect.bisect_left(self._sorted, (key,))
+        for i in range(start, len(self._sorted)):
+            name, entity_id = self._sorted[i]
+            if not name.startswith(key) or len(results) >= limit:
+                break
+            if entity_id not in results:
+                results.append(entity_id)
+        return results
+
+    def fuzzy(self, text: str, limit: int = 25) -> list:
+        postings = [self._grams[gram] for gram in _trigrams(normalize(text)) if gram in self._grams]
+        if not postings:
+            return []
+        # Candidates only come from the rarer half of the query's trigrams, and from no more of them than MAX_SCANNED
+        # ids' worth. Common ones ("  a", "the") match a large part of the index and would make every lookup scan it.
+        postings.sort(key=len)
+        half = max(1, (len(postings) + 1) // 2)
+        scores = Counter(postings[0])
+        rare, scanned = 1, len(postings[0])
+        while rare < half and scanned + len(postings[rare]) <= MAX_SCANNED:
+            scores.update(postings[rare])
+            scanned += len(postings[rare])
+            rare += 1
+        # Only the candidates sharing the most of those trigrams are scored against the rest, each of which is
+        # intersected with them once, so the cost stays bounded by MAX_CANDIDATES however large the postings are.
+        if len(scores) > MAX_CANDIDATES:
+            scores = Counter(dict(scores.most_common(MAX_CANDIDATES)))
+        candidates = set(scores)
+        for posting in postings[rare:]:
+            scores.update(candidates & posting)
+        # Rank by shared trigrams, and prefer shorter names among equals so "Naruto" beats "Naruto Shippuden".
+        return heapq.nsmallest(limit, scores, key=lambda entity_id: (-scores[entity_id], self._shortest[entity_id]))
+
+    def complete(self, text: str, limit: int = 25) -> list:
+        """Returns up to `limit` (id, label) pairs for autocomplete: prefix matches first, then fuzzy matches. """
+        if not normalize(text):
+            return []
+        ids = self.prefix(text, limit)
+        if len(ids) < limit:
+            ids += [entity_id for entity_id in self.fuzzy(text, limit) if entity_id not in ids][:limit - len(ids)]
+        return [(entity_id, self.labels[entity_id]) for entity_id in ids]
+
+
+anime = SearchIndex()
+characters = SearchIndex()
+
+
+def add_anime(anime_id: int, romaji: str, english: str = None, synonyms: list = None):
+    anime.add(anime_id, [romaji, english, *(synonyms or [])])
+
+
+def add_character(char_id: int, name: str, alternative: list = None):
+    characters.add(char_id, [name, *(alternative or [])])
+
+
+def seed(path: str) -> int:
+    """Loads a bulk seed of anime titles from a JSON Lines file of {"id", "romaji", "english", "synonyms"} objects.
+    Returns how many were read. """
+    count = 0
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            add_anime(entry['id'], entry.get('romaji'), entry.get('english'), entry.get('synonyms'))
+            count += 1
+    return count
@@ -0,0 +1,33 @@
+import asyncio
+import resilience
+
+
+class SingleFlight:
+    """Shares one in-flight call between every concurrent caller asking for the same key.
+
+    do(key, call) awaits call() unless a call for `key` is already running, in which case it waits for that one
+    instead. Every waiter gets the same result object, or the same exception, so results must be treated as read-only.
+    Once the call finishes the key is forgotten, so nothing is cached beyond its lifetime. """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, call):
+        task = self._calls.get(key)
+        if task is None:
+            # Without a deadline, since it is shared; every waiter gives up at its own (see resilience.within_deadline()).
+            task = resilience.detach(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        # shield() so one cancelled waiter doesn't cancel the call for everyone else sharing it.
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        self._calls.pop(key, None)
+        # Every caller may have stopped waiting (each has its own deadline), so the exception is marked as retrieved
+        # here to keep asyncio from reporting it as never retrieved.
+        if not task.cancelled():
+            task.exception()
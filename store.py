@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Store:
+    """Persistent cache records in a local SQLite file, shared by every bot process on the machine.
+
+    Records are JSON values filed under (namespace, key), each stamped with the wall-clock time it was stored so a
+    reader can work out how fresh it is. The database runs in WAL mode, so any number of processes can read while
+    one writes. Writes go through a single background thread so the event loop never waits on the disk; reads are
+    small indexed lookups and are done inline. When the stored values pass max_bytes the oldest records are evicted. """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS records_stored_at ON records (stored_at)")
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, so each thread gets its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(key) -> str:
+        return key if isinstance(key, str) else json.dumps(key)
+
+    def get(self, namespace: str, key):
+        """Returns (value, stored_at) for a stored record, or None. """
+        row = self._connection().execute("SELECT value, stored_at FROM records WHERE namespace = ? AND key = ?", (namespace, self._key(key))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def values(self, namespace: str):
+        """Yields every stored value in a namespace. """
+        for (value,) in self._connection().execute("SELECT value FROM records WHERE namespace = ?", (namespace,)):
+            yield json.loads(value)
+
+    def put(self, namespace: str, key, value, stored_at: float = None):
+        """Queues a record to be written in the background. """
+        if stored_at is None:
+            stored_at = time.time()
+        self._writer.submit(self._put, namespace, self._key(key), json.dumps(value), stored_at)
+
+    def _put(self, namespace: str, key: str, value: str, stored_at: float):
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO records (namespace, key, value, stored_at, size) VALUES (?, ?, ?, ?, ?)",
+                               (namespace, key, value, stored_at, len(value)))
+        self._writes += 1
+        # Summing the sizes is a full scan, so the budget is only checked every so often.
+        if self._writes % 500 == 0:
+            self._evict()
+
+    def delete(self, namespace: str, key):
+        self._writer.submit(self._delete, namespace, self._key(key))
+
+    def _delete(self, namespace: str, key: str):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM records WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def _evict(self):
+        connection = self._connection()
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM records").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Trim to 90% of the budget so eviction doesn't run again on the very next check.
+        excess = total - int(self.max_bytes * 0.9)
+        with connection:
+            connection.execute("""
+                DELETE FROM records WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, size, SUM(size) OVER (ORDER BY stored_at ROWS UNBOUNDED PRECEDING) AS running FROM records
+                    ) WHERE running - size < ?
+                )
+            """, (excess,))
+
+    def close(self):
+        self._writer.shutdown(wait=True)